@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+from scipy import sparse
+
+from similarity import SimilarityFilter, iter_similarity_blocks, keep_top_n
+from sparse_ratings import normalize_rows, rating_indicator, row_norms
+
+DEFAULT_TABLES = 16
+DEFAULT_BITS = 8
+MAX_BUCKET = 64
+PAIRS_PER_BLOCK = 1 << 20
+
+
+def bucket_pairs(codes, rng, max_bucket=MAX_BUCKET):
+    # pares (u, v), u < v, de usuarios com o mesmo codigo; baldes grandes sao embaralhados
+    # e cortados em pedacos de max_bucket para o numero de pares ficar linear em usuarios
+    order = np.lexsort((rng.random(codes.shape[0]), codes))
+    sorted_codes = codes[order]
+    new_bucket = np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1]))
+    bucket_start = np.maximum.accumulate(np.where(new_bucket, np.arange(codes.shape[0]), 0))
+    pos_in_bucket = np.arange(codes.shape[0]) - bucket_start
+    chunk_key = np.cumsum(new_bucket) * (codes.shape[0] // max_bucket + 1) + pos_in_bucket // max_bucket
+
+    new_chunk = np.concatenate(([True], chunk_key[1:] != chunk_key[:-1]))
+    chunk_starts = np.flatnonzero(new_chunk)
+    chunk_sizes = np.diff(np.append(chunk_starts, codes.shape[0]))
+    chunk_of = np.cumsum(new_chunk) - 1
+
+    size_e = chunk_sizes[chunk_of]
+    left = np.repeat(np.arange(codes.shape[0]), size_e)
+    offset = np.arange(left.shape[0]) - np.repeat(np.cumsum(size_e) - size_e, size_e)
+    right = np.repeat(chunk_starts[chunk_of], size_e) + offset
+    keep = left < right
+    u, v = order[left[keep]], order[right[keep]]
+    return np.minimum(u, v), np.maximum(u, v)
+
+
+def pair_similarities(D, u, v, pairs_per_block=PAIRS_PER_BLOCK):
+    sims = np.empty(u.shape[0], dtype='float32')
+    for start in range(0, u.shape[0], pairs_per_block):
+        end = min(start + pairs_per_block, u.shape[0])
+        sims[start:end] = np.asarray(D[u[start:end]].multiply(D[v[start:end]]).sum(axis=1)).ravel()
+    return sims
+
+
+def lsh_neighbours(RatingMatrix, n_neighbours, n_tables=DEFAULT_TABLES, n_bits=DEFAULT_BITS, seed=0, norms=None,
+                   filters=None):
+    # vizinhos aproximados por LSH de projecoes aleatorias (hiperplanos): usuarios que caem
+    # no mesmo balde em alguma tabela viram candidatos e tem o cosseno exato calculado
+    # (com os mesmos filtros da busca exata)
+    if filters is None:
+        filters = SimilarityFilter()
+    rng = np.random.default_rng(seed)
+    if norms is None:
+        norms = row_norms(RatingMatrix)
+    D = normalize_rows(RatingMatrix, norms)
+    num_users = D.shape[0]
+    powers = (1 << np.arange(n_bits)).astype('int64')
+
+    us, vs = [], []
+    for _ in range(n_tables):
+        planes = rng.standard_normal((D.shape[1], n_bits)).astype('float32')
+        codes = ((D @ planes) > 0).astype('int64') @ powers
+        u, v = bucket_pairs(codes, rng)
+        us.append(u)
+        vs.append(v)
+    keys = np.unique(np.concatenate(us).astype('int64') * num_users + np.concatenate(vs))
+    u, v = keys // num_users, keys % num_users
+    sims = pair_similarities(D, u, v)
+    self_sims = (norms > 0).astype('float32')
+    if filters.uses_common:
+        # o mesmo produto linha a linha sobre a indicadora conta as notas em comum
+        sims *= filters.weights(pair_similarities(rating_indicator(D), u, v))
+        self_sims *= filters.weights(np.diff(D.indptr))
+    filters.threshold(sims)
+    filters.threshold(self_sims)
+
+    # matriz simetrica com os pares candidatos, mais a propria similaridade de cada usuario
+    diag = np.arange(num_users)
+    Candidates = sparse.csr_matrix((np.concatenate((sims, sims, self_sims)),
+                                    (np.concatenate((u, v, diag)), np.concatenate((v, u, diag)))),
+                                   shape=(num_users, num_users), dtype='float32')
+    Candidates.eliminate_zeros()
+    Candidates.sort_indices()
+    Neighbours = keep_top_n(Candidates, n_neighbours)
+    Neighbours.sort_indices()
+    return Neighbours
+
+
+def top_k_sets(Matrix, k):
+    # conjuntos dos k maiores de cada linha
+    sets = []
+    for row in range(Matrix.shape[0]):
+        start, end = Matrix.indptr[row], Matrix.indptr[row + 1]
+        data, indices = Matrix.data[start:end], Matrix.indices[start:end]
+        sets.append(set(indices[np.argsort(-data, kind='stable')[:k]].tolist()))
+    return sets
+
+
+def recall_report(RatingMatrix, n_neighbours, tables_list, n_bits=DEFAULT_BITS, k=30, sample=1000, seed=0):
+    # recall@k dos vizinhos aproximados contra o top-k exato, numa amostra de usuarios
+    rng = np.random.default_rng(seed)
+    norms = row_norms(RatingMatrix)
+    users = np.flatnonzero(norms > 0)
+    users = np.sort(rng.choice(users, size=min(sample, users.shape[0]), replace=False))
+
+    start = time.time()
+    Exact = sparse.vstack([SimBlock for _, _, SimBlock in
+                           iter_similarity_blocks(RatingMatrix, norms=norms, rows=users)], format='csr')
+    exact_time = (time.time() - start) * RatingMatrix.shape[0] / max(users.shape[0], 1)
+    exact = top_k_sets(Exact, k)
+
+    report = [{'mode': 'exact', 'recall': 1.0, 'seconds': exact_time}]
+    for n_tables in tables_list:
+        start = time.time()
+        Approx = lsh_neighbours(RatingMatrix, n_neighbours, n_tables=n_tables, n_bits=n_bits, seed=seed, norms=norms)
+        seconds = time.time() - start
+        approx = top_k_sets(Approx[users], k)
+        hits = sum(len(a & e) for a, e in zip(approx, exact))
+        total = sum(len(e) for e in exact)
+        report.append({'mode': 'lsh', 'tables': n_tables, 'bits': n_bits,
+                       'recall': hits / total if total else 1.0, 'seconds': seconds})
+    return report
@@ -0,0 +1,144 @@
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import scipy
+
+from model import MODEL_VERSION, Model
+from prediction import DEFAULT_K
+from profiling import Profiler, peak_rss_mb
+from ratings_io import PredictionWriter, iter_targets, read_ratings
+from similarity import DEFAULT_NEIGHBOURS, blocked_cosine_similarity
+from sparse_ratings import build_rating_matrix, row_norms
+
+DEFAULT_USERS = 10000
+DEFAULT_ITEMS = 5000
+DEFAULT_DENSITY = 0.002
+DEFAULT_TARGETS = 50000
+DEFAULT_SKEW = 1.1
+DEFAULT_COLD = 0.05
+
+
+def write_pairs(fname, header, users, movs, grades=None, chunk=1 << 20):
+    with open(fname, "wb") as f:
+        f.write(header)
+        for start in range(0, users.shape[0], chunk):
+            u, m = users[start:start + chunk].tolist(), movs[start:start + chunk].tolist()
+            if grades is None:
+                f.write(b"".join(b"u%07d:i%07d\n" % pair for pair in zip(u, m)))
+            else:
+                g = grades[start:start + chunk].tolist()
+                f.write(b"".join(b"u%07d:i%07d,%d\n" % row for row in zip(u, m, g)))
+
+
+def generate_dataset(directory, n_users=DEFAULT_USERS, n_items=DEFAULT_ITEMS, density=DEFAULT_DENSITY,
+                     n_targets=DEFAULT_TARGETS, skew=DEFAULT_SKEW, cold=DEFAULT_COLD, seed=0):
+    # ratings.csv e targets.csv sinteticos no formato uXXXXXXX:iXXXXXXX. A popularidade dos
+    # filmes segue uma lei de potencia (skew) e uma fracao 'cold' dos targets usa usuarios
+    # ou filmes que nao aparecem nas ratings
+    rng = np.random.default_rng(seed)
+    user_ids = np.sort(rng.choice(9000000, n_users + n_targets, replace=False))
+    mov_ids = np.sort(rng.choice(9000000, n_items + n_targets, replace=False))
+    rng.shuffle(user_ids)
+    rng.shuffle(mov_ids)
+    known_users, cold_users = user_ids[:n_users], user_ids[n_users:]
+    known_movs, cold_movs = mov_ids[:n_items], mov_ids[n_items:]
+
+    popularity = 1.0 / np.arange(1, n_items + 1) ** skew
+    popularity /= popularity.sum()
+    n_ratings = int(density * n_users * n_items)
+    pairs = np.unique(rng.integers(0, n_users, n_ratings).astype('int64') * n_items
+                      + rng.choice(n_items, n_ratings, p=popularity))
+    rng.shuffle(pairs)
+    users, movs = known_users[pairs // n_items], known_movs[pairs % n_items]
+    grades = rng.integers(1, 11, pairs.shape[0])
+
+    t_users = known_users[rng.integers(0, n_users, n_targets)]
+    t_movs = known_movs[rng.choice(n_items, n_targets, p=popularity)]
+    is_cold = rng.random(n_targets) < cold
+    cold_user = is_cold & (rng.random(n_targets) < 0.5)
+    t_users = np.where(cold_user, cold_users, t_users)
+    t_movs = np.where(is_cold & ~cold_user, cold_movs, t_movs)
+
+    os.makedirs(directory, exist_ok=True)
+    ratings = os.path.join(directory, "ratings.csv")
+    targets = os.path.join(directory, "targets.csv")
+    write_pairs(ratings, b"UserId:ItemId,Prediction\n", users, movs, grades)
+    write_pairs(targets, b"UserId:ItemId\n", t_users, t_movs)
+    return ratings, targets, {'users': n_users, 'items': n_items, 'density': density, 'ratings': int(pairs.shape[0]),
+                              'targets': n_targets, 'skew': skew, 'cold': cold, 'seed': seed}
+
+
+def predict_targets(model, targets, k):
+    names, recs = [], []
+    for lines, users, movs in iter_targets(targets):
+        names.extend(lines)
+        recs.append(model.predict(users, movs, k=k))
+    return names, np.concatenate(recs) if recs else np.zeros(0)
+
+
+def write_output(output, names, recs):
+    with PredictionWriter(output) as writer:
+        writer.write(names, recs)
+
+
+def run_benchmark(ratings, targets, output, n_neighbours=DEFAULT_NEIGHBOURS, k=DEFAULT_K,
+                  block_size=None, memory_mb=None, profiler=None):
+    # roda as etapas do pipeline uma a uma (leitura, pivot, normas, similaridades,
+    # predicao e gravacao) e devolve as medidas de cada uma
+    profiler = profiler if profiler is not None else Profiler(echo=False)
+    first = len(profiler.records)
+
+    def measure(name, items=None):
+        return profiler.stage(name, items=items)
+
+    with measure("parse") as record:
+        users, movs, grades = read_ratings(ratings)
+        record['items'] = users.shape[0]
+    with measure("pivot", users.shape[0]):
+        RatingMatrix, user_map, mov_map = build_rating_matrix(users, movs, grades)
+    del users, movs, grades
+    with measure("norms", RatingMatrix.shape[0]):
+        norms = row_norms(RatingMatrix)
+    with measure("similarity", RatingMatrix.shape[0]):
+        Neighbours = blocked_cosine_similarity(RatingMatrix, block_size=block_size, memory_mb=memory_mb,
+                                               n_neighbours=n_neighbours, norms=norms)
+    with measure("index", Neighbours.nnz):
+        model = Model(RatingMatrix, Neighbours, user_map, mov_map,
+                      {'n_neighbours': n_neighbours, 'similarity': 'cosine', 'search': 'exact', 'mode': 'user'},
+                      norms=norms)
+    with measure("predict") as record:
+        names, recs = predict_targets(model, targets, k)
+        record['items'] = recs.shape[0]
+    with measure("write", recs.shape[0]):
+        write_output(output, names, recs)
+
+    stages = profiler.records[first:]
+    for row in stages:
+        print("  %-10s %8.3fs %10.1f MB %14.0f itens/s" % (row['stage'], row['seconds'], row['peak_rss_mb'],
+                                                           row['items_per_second'] or 0))
+    return stages
+
+
+def benchmark_report(stages, dataset, params):
+    return {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'model_version': MODEL_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'dataset': dataset,
+        'params': params,
+        'stages': stages,
+        'total_seconds': sum(s['seconds'] for s in stages),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def write_report(fname, report):
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from prediction import DEFAULT_K
+from recommend import DEFAULT_SUPPORT_SHRINKAGE, DEFAULT_TOP_N, candidate_scores, fill_popular
+
+DEFAULT_PREDICTION_CACHE = 1 << 20
+DEFAULT_NEIGHBOURHOOD_CACHE = 4096
+
+
+class LRUCache:
+    # dicionario limitado com descarte do menos usado e contadores de acerto/erro;
+    # protegido por lock para ser usado pelas threads do servidor
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+class CachedModel:
+    # modelo com cache das predicoes por (usuario, filme, k) e da vizinhanca ja pontuada de
+    # cada usuario (candidatos do top-N); o resto e repassado ao modelo original
+
+    def __init__(self, model, prediction_cache=DEFAULT_PREDICTION_CACHE,
+                 neighbourhood_cache=DEFAULT_NEIGHBOURHOOD_CACHE):
+        self.model = model
+        self.predictions = LRUCache(prediction_cache)
+        self.neighbourhoods = LRUCache(neighbourhood_cache)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def predict(self, users_rec, movs_rec, k=DEFAULT_K):
+        users_rec, movs_rec = np.asarray(users_rec), np.asarray(movs_rec)
+        preds = np.empty(users_rec.shape[0], dtype='float64')
+        missing = []
+        for i, key in enumerate(zip(users_rec.tolist(), movs_rec.tolist())):
+            value = self.predictions.get(key + (k,))
+            if value is None:
+                missing.append(i)
+            else:
+                preds[i] = value
+        if missing:
+            missing = np.asarray(missing)
+            values = self.model.predict(users_rec[missing], movs_rec[missing], k=k)
+            preds[missing] = values
+            for user, mov, value in zip(users_rec[missing].tolist(), movs_rec[missing].tolist(), values.tolist()):
+                self.predictions.put((user, mov, k), value)
+        return preds
+
+    def neighbourhood(self, ind_user, k=DEFAULT_K, min_support=1, shrinkage=DEFAULT_SUPPORT_SHRINKAGE):
+        # todos os candidatos do usuario ja pontuados e ordenados; serve qualquer n
+        key = (int(ind_user), k, min_support, shrinkage)
+        ranked = self.neighbourhoods.get(key)
+        if ranked is None:
+            _, items, scores = candidate_scores(self.model, np.asarray([ind_user]), k=k, min_support=min_support,
+                                                shrinkage=shrinkage)
+            order = np.lexsort((items, -scores))
+            ranked = (items[order], scores[order])
+            self.neighbourhoods.put(key, ranked)
+        return ranked
+
+    def recommend(self, user_id, n=DEFAULT_TOP_N, k=DEFAULT_K, min_support=1, shrinkage=DEFAULT_SUPPORT_SHRINKAGE):
+        ind_user = self.model.user_map.get(user_id)
+        if ind_user >= 0 and self.model.tables.user_counts[ind_user] > 0:
+            items, scores = self.neighbourhood(ind_user, k=k, min_support=min_support, shrinkage=shrinkage)
+            items, scores = items[:n], scores[:n]
+        else:
+            ind_user = -1
+            items, scores = np.zeros(0, dtype='int64'), np.zeros(0)
+        if items.shape[0] < n:
+            items, scores = fill_popular(self.model, ind_user, items, scores, n)
+        return self.model.mov_map.ids[items], scores
+
+    def cache_stats(self):
+        return {'predictions': self.predictions.stats(), 'neighbourhoods': self.neighbourhoods.stats()}
@@ -0,0 +1,68 @@
+import time
+
+import numpy as np
+
+from model import Model
+from prediction import DEFAULT_K, column_index
+from similarity import SIM_DTYPES, quantize_similarities
+from sparse_ratings import compact_grades
+
+MODEL_ARRAYS = ('RatingMatrix', 'RatingCsc', 'Neighbours', 'keys', 'neighbour_keys', 'norms')
+
+
+def array_bytes(value):
+    if value is None:
+        return 0
+    if hasattr(value, 'indptr'):
+        return int(value.data.nbytes + value.indices.nbytes + value.indptr.nbytes)
+    return int(np.asarray(value).nbytes)
+
+
+def model_bytes(model):
+    # bytes de cada estrutura da predicao (as tabelas de reserva e os ids nao mudam)
+    sizes = {name: array_bytes(getattr(model, name)) for name in MODEL_ARRAYS}
+    sizes['total'] = sum(sizes.values())
+    return sizes
+
+
+def compact_model(model, sim_dtype):
+    # mesma compactacao do fit com compact=sim_dtype, aplicada a um modelo ja ajustado (sem as
+    # chaves int64, como no fit compacto)
+    RatingMatrix = compact_grades(model.RatingMatrix)
+    Neighbours = quantize_similarities(model.Neighbours, sim_dtype)
+    return Model(RatingMatrix, Neighbours, model.user_map, model.mov_map, dict(model.meta, compact=sim_dtype),
+                 RatingCsc=column_index(RatingMatrix), norms=model.norms, tables=model.tables)
+
+
+def timed_predict(model, users, movs, k):
+    start = time.perf_counter()
+    preds = np.asarray(model.predict(users, movs, k=k), dtype='float64')
+    return preds, time.perf_counter() - start
+
+
+def drift_metrics(preds, reference):
+    # diferenca para as predicoes em precisao cheia; 'changed' conta as que mudam na saida (4 casas)
+    diff = np.abs(preds - reference)
+    if diff.shape[0] == 0:
+        return {'count': 0, 'max_abs': None, 'mean_abs': None, 'rmse': None, 'changed': 0}
+    return {'count': int(diff.shape[0]), 'max_abs': float(diff.max()), 'mean_abs': float(diff.mean()),
+            'rmse': float(np.sqrt(np.mean(diff ** 2))),
+            'changed': int(np.count_nonzero(np.round(preds, 4) != np.round(reference, 4)))}
+
+
+def compact_report(model, users, movs, k=DEFAULT_K, sim_dtypes=SIM_DTYPES):
+    # memoria do modelo compacto (notas uint8 + similaridades em cada tipo) contra o de
+    # precisao cheia e o desvio das predicoes dos targets
+    reference, seconds = timed_predict(model, users, movs, k)
+    full = model_bytes(model)
+    rows = [{'storage': 'float32', 'bytes': full, 'saved': 0.0, 'neighbours': int(model.Neighbours.nnz),
+             'seconds': seconds, 'drift': drift_metrics(reference, reference)}]
+    for sim_dtype in sim_dtypes:
+        compact = compact_model(model, sim_dtype)
+        preds, seconds = timed_predict(compact, users, movs, k)
+        sizes = model_bytes(compact)
+        rows.append({'storage': sim_dtype, 'bytes': sizes,
+                     'saved': 1.0 - sizes['total'] / full['total'] if full['total'] else 0.0,
+                     'neighbours': int(compact.Neighbours.nnz), 'seconds': seconds,
+                     'drift': drift_metrics(preds, reference)})
+    return rows
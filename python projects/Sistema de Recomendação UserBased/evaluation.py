@@ -0,0 +1,73 @@
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+from parallel import parallel_model
+from prediction import DEFAULT_K
+from sparse_ratings import last_rating_per_pair
+
+DEFAULT_HOLDOUT = 0.1
+SEGMENTS = ('warm', 'cold_user', 'cold_item', 'cold_both')
+
+
+def holdout_split(users, movs, grades, fraction=DEFAULT_HOLDOUT, per_user=False, seed=0):
+    # separa as ratings (uma por par usuario/filme) em treino e holdout. 'random' sorteia
+    # entre todas; per_user separa a mesma fracao de cada usuario, mantendo ao menos uma
+    # rating dele no treino
+    users, movs, grades = last_rating_per_pair(users, movs, grades)
+    rated = grades != 0
+    users, movs, grades = users[rated], movs[rated], grades[rated]
+    rng = np.random.default_rng(seed)
+    draw = rng.random(users.shape[0])
+    if not per_user:
+        test = draw < fraction
+    else:
+        order = np.lexsort((draw, users))
+        sorted_users = users[order]
+        first = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+        counts = np.diff(np.r_[first, sorted_users.shape[0]])
+        rank = np.arange(users.shape[0]) - np.repeat(first, counts)
+        held = np.minimum(np.round(counts * fraction), counts - 1).astype('int64')
+        test = np.zeros(users.shape[0], dtype=bool)
+        test[order] = rank < np.repeat(held, counts)
+    train = ~test
+    return (users[train], movs[train], grades[train]), (users[test], movs[test], grades[test])
+
+
+def segments(model, users, movs):
+    # usuario/filme sem nenhuma rating no treino caem nas medias de reserva da predicao
+    ind_user, known_user = model.user_map.lookup(users)
+    ind_mov, known_mov = model.mov_map.lookup(movs)
+    warm_user = known_user & (np.asarray(model.tables.user_counts)[ind_user] > 0)
+    warm_mov = known_mov & (np.asarray(model.tables.mov_counts)[ind_mov] > 0)
+    return {'warm': warm_user & warm_mov, 'cold_user': ~warm_user & warm_mov,
+            'cold_item': warm_user & ~warm_mov, 'cold_both': ~warm_user & ~warm_mov}
+
+
+def error_metrics(preds, grades):
+    errors = preds - grades
+    if errors.shape[0] == 0:
+        return {'count': 0, 'rmse': None, 'mae': None}
+    return {'count': int(errors.shape[0]), 'rmse': float(np.sqrt(np.mean(errors ** 2))),
+            'mae': float(np.mean(np.abs(errors)))}
+
+
+def evaluate(model, users, movs, grades, ks=(DEFAULT_K,), workers=1):
+    # RMSE/MAE do holdout para cada k, no total e por segmento (quente, usuario frio,
+    # filme frio, ambos frios), com a vazao da predicao em lote
+    grades = np.asarray(grades, dtype='float64')
+    masks = segments(model, users, movs)
+    with (parallel_model(model, workers) if workers != 1 else nullcontext(model)) as predictor:
+        results = []
+        for k in ks:
+            start = time.perf_counter()
+            preds = predictor.predict(users, movs, k=k)
+            seconds = time.perf_counter() - start
+            preds = np.asarray(preds, dtype='float64')
+            row = {'k': k, 'seconds': seconds,
+                   'predictions_per_second': users.shape[0] / seconds if seconds > 0 else None}
+            row.update(error_metrics(preds, grades))
+            row['segments'] = {name: error_metrics(preds[masks[name]], grades[masks[name]]) for name in SEGMENTS}
+            results.append(row)
+    return results
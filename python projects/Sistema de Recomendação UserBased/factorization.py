@@ -0,0 +1,165 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from prediction import FallbackTables, cold_start, column_index, fallback_tables
+from rating_cache import load_array, load_csr, save_array, save_csr
+from sparse_ratings import IdIndex
+
+DEFAULT_FACTORS = 32
+DEFAULT_ITERATIONS = 10
+DEFAULT_REG = 0.05
+BLOCK_BYTES = 64 * 1024 * 1024
+TABLE_ARRAYS = ('user_sums', 'user_counts', 'mov_sums', 'mov_counts')
+FACTOR_ARRAYS = ('user_factors', 'mov_factors', 'user_bias', 'mov_bias')
+
+
+class FactorModel:
+    # fatoracao com vieses: nota ~ media + b_usuario + b_filme + p_usuario . q_filme.
+    # Guarda as ratings (filmes ja vistos no top-N) e as mesmas tabelas de reserva do
+    # modelo de vizinhos, entao usuario/filme frio recebe exatamente a mesma predicao
+
+    mode = 'mf'
+
+    def __init__(self, RatingMatrix, user_factors, mov_factors, user_bias, mov_bias, user_map, mov_map,
+                 meta, tables=None):
+        self.RatingMatrix = RatingMatrix
+        self.user_factors = user_factors
+        self.mov_factors = mov_factors
+        self.user_bias = user_bias
+        self.mov_bias = mov_bias
+        self.user_map = user_map
+        self.mov_map = mov_map
+        self.meta = meta
+        self.tables = tables if tables is not None else fallback_tables(RatingMatrix)
+
+    def score(self, ind_user, ind_mov):
+        # nota dos pares quentes, limitada a faixa das notas de treino
+        scores = (self.meta['global_mean'] + np.asarray(self.user_bias)[ind_user]
+                  + np.asarray(self.mov_bias)[ind_mov] + np.einsum('ij,ij->i', self.user_factors[ind_user], self.mov_factors[ind_mov]))
+        return np.clip(scores, self.meta['min_grade'], self.meta['max_grade'])
+
+    def predict(self, users_rec, movs_rec, k=None):
+        # k nao se aplica (mantido pela mesma assinatura do modelo de vizinhos)
+        recomendation, ind_user, ind_mov, warm = cold_start(users_rec, movs_rec, self.user_map, self.mov_map,
+                                                            self.tables)
+        recomendation[warm] = self.score(ind_user[warm], ind_mov[warm])
+        return recomendation
+
+
+def normal_matrices(X, indices, indptr, chunk):
+    # x^T x das notas de cada linha sem um produto externo por nota: as linhas sao agrupadas por
+    # tamanho (potencias de 2), completadas com uma linha de zeros de X e multiplicadas em lote
+    # com ate `chunk` notas por vez; linhas com mais de `chunk` notas somam os pedacos
+    width = X.shape[1]
+    Xz = np.vstack((X, np.zeros((1, width))))
+    padded = np.append(indices, X.shape[0])
+    counts = np.diff(indptr)
+    A = np.zeros((counts.shape[0], width, width))
+    size = 1
+    while counts.shape[0] and size // 2 < min(int(counts.max()), chunk):
+        cols = np.arange(min(size, chunk))
+        rows = np.flatnonzero((counts > size // 2) & (counts <= cols.shape[0]))
+        per = max(1, chunk // cols.shape[0])
+        for i in range(0, rows.shape[0], per):
+            sel = rows[i:i + per]
+            pos = np.where(cols[None, :] < counts[sel][:, None], indptr[sel][:, None] + cols[None, :], indices.shape[0])
+            G = Xz[padded[pos]]
+            A[sel] = np.matmul(G.transpose(0, 2, 1), G)
+        size *= 2
+    for row in np.flatnonzero(counts > chunk):
+        for lo in range(indptr[row], indptr[row + 1], chunk):
+            G = X[indices[lo:min(lo + chunk, indptr[row + 1])]]
+            A[row] += G.T @ G
+    return A
+
+
+def solve_rows(Matrix, start, end, X, targets, reg, factors, bias, chunk):
+    # minimos quadrados regularizados de cada linha [start, end) com x = [fatores fixos, 1]:
+    # as matrizes normais do bloco saem so das linhas de X das notas do bloco
+    lo, hi = Matrix.indptr[start], Matrix.indptr[end]
+    indptr = Matrix.indptr[start:end + 1] - lo
+    indices = Matrix.indices[lo:hi]
+    shape = (end - start, Matrix.shape[1])
+    counts = np.diff(indptr)
+    rated = counts > 0
+    width = X.shape[1]
+    A = normal_matrices(X, indices, indptr, chunk)
+    b = sparse.csr_matrix((targets[lo:hi], indices, indptr), shape=shape) @ X
+    A += reg * counts[:, None, None] * np.eye(width)
+    out = np.zeros((end - start, width))
+    out[rated] = np.linalg.solve(A[rated], b[rated][..., None])[..., 0]
+    factors[start:end], bias[start:end] = out[:, :-1], out[:, -1]
+
+
+def als_step(Matrix, fixed, fixed_bias, offset, reg, factors, bias, pool):
+    # resolve todas as linhas de Matrix com o outro lado fixo, em blocos de linhas na pool;
+    # cada bloco guarda uma matriz d x d por linha e as linhas de X de um pedaco de notas, as
+    # duas limitadas por BLOCK_BYTES (nada proporcional ao outro lado inteiro)
+    X = np.hstack((fixed, np.ones((fixed.shape[0], 1))))
+    targets = np.asarray(Matrix.data, dtype='float64') - offset - fixed_bias[Matrix.indices]
+    block = max(1, BLOCK_BYTES // (X.shape[1] ** 2 * 8))
+    chunk = max(1, BLOCK_BYTES // (X.shape[1] * 8))
+    list(pool.map(lambda start: solve_rows(Matrix, start, min(start + block, Matrix.shape[0]), X, targets,
+                                           reg, factors, bias, chunk), range(0, Matrix.shape[0], block)))
+
+
+def train_rmse(RatingMatrix, model):
+    rows = np.repeat(np.arange(RatingMatrix.shape[0]), np.diff(RatingMatrix.indptr))
+    errors = model.score(rows, RatingMatrix.indices) - RatingMatrix.data
+    return float(np.sqrt(np.mean(errors ** 2))) if errors.shape[0] else 0.0
+
+
+def fit_factors(RatingMatrix, user_map, mov_map, n_factors=DEFAULT_FACTORS, iterations=DEFAULT_ITERATIONS,
+                reg=DEFAULT_REG, workers=None, seed=0):
+    # ALS com vieses: alterna a solucao exata dos usuarios (filmes fixos) e dos filmes
+    # (usuarios fixos). Cada passo resolve blocos de linhas em paralelo numa pool de threads
+    # (o numpy libera o GIL nas contas); o custo de cada iteracao e linear no numero de ratings
+    rng = np.random.default_rng(seed)
+    RatingCsc = column_index(RatingMatrix)
+    ItemRows = RatingCsc.T
+    grades = np.asarray(RatingMatrix.data, dtype='float64')
+    global_mean = float(grades.mean()) if grades.shape[0] else 0.0
+    user_factors = np.zeros((RatingMatrix.shape[0], n_factors))
+    mov_factors = rng.normal(0, 0.1, (RatingMatrix.shape[1], n_factors))
+    user_bias = np.zeros(RatingMatrix.shape[0])
+    mov_bias = np.zeros(RatingMatrix.shape[1])
+    meta = {'engine': 'mf', 'mode': 'mf', 'factors': n_factors, 'iterations': iterations, 'reg': reg,
+            'global_mean': global_mean, 'min_grade': float(grades.min()) if grades.shape[0] else 0.0,
+            'max_grade': float(grades.max()) if grades.shape[0] else 0.0}
+    model = FactorModel(RatingMatrix, user_factors, mov_factors, user_bias, mov_bias, user_map, mov_map, meta)
+
+    with ThreadPoolExecutor(max_workers=workers if workers else os.cpu_count()) as pool:
+        for iteration in range(iterations):
+            start = time.time()
+            als_step(RatingMatrix, mov_factors, mov_bias, global_mean, reg, user_factors, user_bias, pool)
+            als_step(ItemRows, user_factors, user_bias, global_mean, reg, mov_factors, mov_bias, pool)
+            print("  iteracao %d: rmse de treino %.4f (%.2fs)"%(iteration + 1, train_rmse(RatingMatrix, model),
+                                                             time.time() - start))
+    return model
+
+
+def save_factor_model(model, model_dir, version):
+    os.makedirs(model_dir, exist_ok=True)
+    save_csr(model_dir, model.RatingMatrix, prefix='ratings_')
+    for name in FACTOR_ARRAYS + TABLE_ARRAYS:
+        source = model.tables if name in TABLE_ARRAYS else model
+        save_array(model_dir, name, getattr(source, name))
+    save_array(model_dir, 'user_ids', model.user_map.ids)
+    save_array(model_dir, 'mov_ids', model.mov_map.ids)
+
+    meta = dict(model.meta, version=version, shape=list(model.RatingMatrix.shape))
+    with open(os.path.join(model_dir, "model.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_factor_model(model_dir, meta):
+    # fatores mapeados em memoria como o resto do modelo
+    RatingMatrix = load_csr(model_dir, meta['shape'], prefix='ratings_')
+    return FactorModel(RatingMatrix, *(load_array(model_dir, name) for name in FACTOR_ARRAYS),
+                       IdIndex(load_array(model_dir, 'user_ids')), IdIndex(load_array(model_dir, 'mov_ids')), meta,
+                       tables=FallbackTables(*(load_array(model_dir, name) for name in TABLE_ARRAYS)))
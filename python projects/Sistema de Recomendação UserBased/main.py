@@ -1,176 +1,514 @@
+import argparse
+import json
+import os
 import sys
-import numpy as np
-import pandas as pd
-import math
 import time
 import warnings
-
-start_time = time.time()
-
-fname = str(sys.argv[1])
-fname2 = str(sys.argv[2])
+from contextlib import contextmanager
+
+from ann import DEFAULT_BITS, DEFAULT_TABLES, recall_report
+from benchmark import (DEFAULT_COLD, DEFAULT_DENSITY, DEFAULT_ITEMS, DEFAULT_SKEW, DEFAULT_TARGETS,
+                       DEFAULT_USERS, benchmark_report, generate_dataset, run_benchmark, write_report)
+from cache import DEFAULT_NEIGHBOURHOOD_CACHE, DEFAULT_PREDICTION_CACHE, CachedModel
+from compact import compact_report
+from evaluation import DEFAULT_HOLDOUT, SEGMENTS, evaluate, holdout_split
+from factorization import DEFAULT_FACTORS, DEFAULT_ITERATIONS, DEFAULT_REG, fit_factors
+from model import MODEL_VERSION, UPDATE_ERROR, fit, load_model, replace_model, save_model, update
+from out_of_core import fit_out_of_core
+from parallel import parallel_model
+from prediction import DEFAULT_K
+from profiling import PROFILER, Profiler, stage, start_time
+from rating_cache import default_cache_dir, load_ratings
+from ratings_io import (PredictionWriter, iter_targets, read_ratings, read_targets, read_user_ids,
+                        write_recommendations)
+from recommend import DEFAULT_SUPPORT_SHRINKAGE, DEFAULT_TOP_N, recommend_batch
+from server import DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH, DEFAULT_PORT, serve
+from similarity import DEFAULT_NEIGHBOURS, SIM_DTYPES, SIMILARITIES
+from sparse_ratings import build_rating_matrix
 
 warnings.filterwarnings("ignore")
 
 
-print("LEITURA...%.2f seconds up to now"%(time.time() - start_time))
-#                    LEITURA DOS ARQUIVOS
-#_______________________________________________________________________
-ratings = np.loadtxt(open(fname, "rb"), delimiter=",", skiprows=0, dtype= str)
-targets = np.loadtxt(open(fname2, "rb"), delimiter=",", skiprows=0, dtype= str)
-
-
-
-
-print("ARMAZENAMENTO E TRATAMENTO...%.2f seconds up to now"%(time.time() - start_time))
-#    ARMAZENAMENTO DAS RATINGS COMO LISTA, RETIRADA DE CABECALHO E DE LETRAS
-#_______________________________________________________________________
-usersitens = np.loadtxt(ratings[:,0], delimiter=":", skiprows=0, dtype= str)
-usersitens[1:,0] = [x[1:] for x in usersitens[1:,0]]
-usersitens[1:,1] = [x[1:] for x in usersitens[1:,1]]
-
-
-
-
-
-print("CRIACAO DO DATAFRAME...%.2f seconds up to now"%(time.time() - start_time))
-#                       CRIACAO DO DATAFRAME
-#_______________________________________________________________________
-RatingDf = pd.DataFrame({'users': usersitens[1:,0],'movies': usersitens[1:,1], 'grades': ratings[1:,1]})
-RatingDf['grades'] = RatingDf['grades'].astype('int16')
-RatingDf['users'] = RatingDf['users'].astype('int32')
-RatingDf['movies'] = RatingDf['movies'].astype('int32')
-#_______________________________________________________________________
-
-
-
-
-
-print("PIVOT DOS RATINGS PARA UMA MATRIZ...%.2f seconds up to now"%(time.time() - start_time))
-#                    PIVOT DOS RATINGS PARA UMA MATRIZ
-#_______________________________________________________________________
-RatingMatrix = RatingDf.pivot(index='users', columns='movies', values='grades')
-del(RatingDf)
-del(usersitens)
-del(ratings)
-#_______________________________________________________________________
-
-
-
-
-
-print("NORMALIZACAO DOS RATINGS...%.2f seconds up to now"%(time.time() - start_time))
-#                      NORMALIZACAO DOS RATINGS
-#_______________________________________________________________________
-#for idx in RatingMatrix.index:
-#      RatingMatrix.loc[idx,:] -=  np.mean(RatingMatrix.loc[idx,:],axis=1,keepdims=True)
-#_______________________________________________________________________
-
-
-
-
-
-print("TRANSFORMACAO DO DATAFRAME EM ARRAY...%.2f seconds up to now"%(time.time() - start_time))
-#      TRANSFORMACAO DO DATAFRAME EM ARRAY NUMPY(ECONOMIZAR MEMORIA)
-#_______________________________________________________________________
-numrows = RatingMatrix.shape[0]
-index = RatingMatrix.index
-movies = RatingMatrix.columns
-NormRating = RatingMatrix.values.astype('float32')
-NormRating[np.isnan(NormRating)] = 0.0
-del(RatingMatrix)
-#_______________________________________________________________________
-
-
-print("CALCULO DAS SIMILARIDADES...%.2f seconds up to now"%(time.time() - start_time))
-#                    CALCULO DAS SIMILARIDADES
-#_______________________________________________________________________
-SimMatrix = np.zeros((1 ,1), dtype='float32')
-C = np.zeros((1 ,1), dtype='float32')
-D = np.zeros((1 ,1), dtype='float32')
-
-
-C = (NormRating.T * NormRating.T).sum(0, keepdims=True) ** .5
-D = NormRating / C.T
-D=np.nan_to_num(D,copy=False,nan=0.0, posinf=0.0, neginf=0.0)
-del(C)
-SimMatrix = D @ D.T
-del(D)
-SimMatrix=np.nan_to_num(SimMatrix,copy=False,nan=0.0, posinf=0.0, neginf=0.0)
-
-
-
-
-
-
-print("LEITURA TARGETS...%.2f seconds up to now"%(time.time() - start_time))
-#                   PREPARACAO DOS TARGETS
-#_______________________________________________________________________
-usersitens = np.loadtxt(targets[:], delimiter=":", skiprows=0, dtype= str)
-usersitens[:,0] = [x[1:] for x in usersitens[:,0]]
-usersitens[:,1] = [x[1:] for x in usersitens[:,1]]
-users_rec = np.asarray(usersitens[1:,0]).astype('int64')
-movs_rec = np.asarray(usersitens[1:,1]).astype('int64')
-del(usersitens)
-#_______________________________________________________________________
-
-
-
-
-
-
-print("PROCESSAMENTO DAS RECOMENDACOES...%.2f seconds up to now"%(time.time() - start_time))
-#                  PROCESSAMENTO DAS RECOMENDACOES
-#____________________________________________________________
-cold_user=False
-cold_mov=False
-media_global = np.mean(NormRating[np.nonzero(NormRating[:,:])])
-recomendation = np.zeros(np.loadtxt(targets[1:], skiprows=0, dtype= str).shape[0], dtype=[('targets', 'U32'), ('recs', float)])
-recomendation['targets'] = np.loadtxt(targets[1:], skiprows=0, dtype= str)
-for r in range(0,users_rec.shape[0]):
-      user = users_rec[r]
-      mov = movs_rec[r] 
-
-      if(len(np.where(index==user)[0]) == 0):
-          cold_user = True
-      else:
-          cold_user = False
-      if(len(np.where(movies==mov)[0]) == 0):
-          cold_mov  = True
-      else:
-          cold_mov = False
-
-      if(cold_user==False and cold_mov  == False):
-          ind_user = np.where(index==user)[0][0]
-          ind_mov = np.where(movies==mov)[0][0]
-          ind_UsersRtdMov = np.asarray(np.where(NormRating[:,ind_mov]>0)[0])
-          ind_similars = np.asarray(np.where(SimMatrix[ind_user,:]!=0)[0])
-          ind_rated_sim = np.where(np.in1d(ind_similars,ind_UsersRtdMov)==True)[0]
-          ind_rated_sim = ind_similars[ind_rated_sim]
-          sim_rated = SimMatrix[ind_user, ind_rated_sim]
-          topk_ind = ind_rated_sim[sim_rated.argsort()[-30:][::-1]]
-          topk_sim = SimMatrix[ind_user,topk_ind]
-          topk_rates = NormRating[topk_ind,ind_mov]
-          if(topk_sim.shape[0]==0):
-               recomendation_now = np.mean(NormRating[ind_UsersRtdMov,ind_mov])
-               #recomendation_now = np.mean(NormRating[ind_user,np.nonzero(NormRating[ind_user,:])])
-          else:
-               recomendation_now = sum(np.multiply(topk_sim,topk_rates))/sum(topk_sim)
-                               
-      elif(cold_user==False and cold_mov  == True):
-          ind_user = np.where(index==user)[0][0]
-          recomendation_now = np.mean(NormRating[ind_user,np.nonzero(NormRating[ind_user,:])])
-
-      elif(cold_user==True and cold_mov==False):
-          ind_mov = np.where(movies==mov)[0][0]
-          ind_UsersRtdMov = np.asarray(np.where(NormRating[:,ind_mov]>0)[0])
-          recomendation_now = np.mean(NormRating[ind_UsersRtdMov,ind_mov])
-          
-      elif(cold_user==True and cold_mov==True):
-          recomendation_now = media_global
-          
-      recomendation['recs'][r] = recomendation_now
-
-#____________________________________________________________
-np.savetxt("saida.csv", recomendation, fmt='%s,%.4f', delimiter=',\n', header='UserId:ItemId,Prediction',comments='')
-print("Tempo Final: %.2f seconds" % (time.time() - start_time))
+def add_profile_arguments(parser):
+    parser.add_argument("--profile-log", default=None,
+                        help="grava uma linha JSON por etapa (tempo, memoria, itens); '-' para a tela")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="mede o pico de memoria de cada etapa com tracemalloc (mais lento)")
+    parser.add_argument("--profile-stage", default=None,
+                        help="etapa gravada com o cProfile (ex.: similarity, predict)")
+    parser.add_argument("--profile-output", default=None,
+                        help="arquivo do cProfile (padrao: <etapa>.prof)")
+
+
+def parse_args(parser, argv):
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    PROFILER.configure(log=args.profile_log, trace_memory=args.trace_memory,
+                       profile_stage=args.profile_stage, profile_output=args.profile_output)
+    return args
+
+
+def add_fit_arguments(parser):
+    parser.add_argument("--block-size", type=int, default=None,
+                        help="usuarios (ou filmes) por bloco no calculo das similaridades")
+    parser.add_argument("--memory-mb", type=float, default=None,
+                        help="memoria maxima por bloco de similaridades (define o block-size)")
+    parser.add_argument("--neighbours", type=int, default=DEFAULT_NEIGHBOURS,
+                        help="vizinhos guardados por usuario (ou filme) no indice (0 guarda todos)")
+    parser.add_argument("--mode", choices=("user", "item"), default="user",
+                        help="filtragem colaborativa user-based ou item-based")
+    parser.add_argument("--similarity", choices=SIMILARITIES, default="cosine",
+                        help="cosseno das notas cruas, pearson (notas menos a media da linha) ou "
+                             "cosseno ajustado (notas menos a media do usuario)")
+    parser.add_argument("--min-common", type=int, default=1,
+                        help="minimo de notas em comum (filmes, ou usuarios no --mode item) para dois usuarios "
+                             "serem vizinhos")
+    parser.add_argument("--shrinkage", type=float, default=0.0,
+                        help="encolhe cada similaridade por n / (n + shrinkage), n = notas em comum")
+    parser.add_argument("--min-similarity", type=float, default=None,
+                        help="similaridade minima (depois do encolhimento) para entrar no indice de vizinhos")
+    parser.add_argument("--engine", choices=("knn", "mf"), default="knn",
+                        help="vizinhos (knn) ou fatoracao de matrizes por ALS (mf)")
+    parser.add_argument("--factors", type=int, default=DEFAULT_FACTORS,
+                        help="dimensao dos fatores da fatoracao (--engine mf)")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="iteracoes do ALS (--engine mf)")
+    parser.add_argument("--reg", type=float, default=DEFAULT_REG,
+                        help="regularizacao do ALS, proporcional as notas de cada linha (--engine mf)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="threads do ALS (0 usa todos os nucleos)")
+    parser.add_argument("--ann", action="store_true",
+                        help="vizinhos aproximados por LSH em vez da busca exata entre todos os pares")
+    parser.add_argument("--compact", choices=SIM_DTYPES, default=None,
+                        help="armazenamento compacto: notas em uint8 e similaridades em float16 ou int8 "
+                             "(--engine knn; exige notas inteiras de 0 a 255)")
+    add_ann_arguments(parser)
+    add_cache_arguments(parser)
+
+
+def add_ann_arguments(parser):
+    parser.add_argument("--ann-tables", type=int, default=DEFAULT_TABLES,
+                        help="tabelas de hash do LSH (mais tabelas: maior recall, mais tempo)")
+    parser.add_argument("--ann-bits", type=int, default=DEFAULT_BITS,
+                        help="hiperplanos por tabela (mais bits: baldes menores)")
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", action="store_true",
+                        help="usa (ou cria) o cache binario das ratings em <ratings>.cache")
+    parser.add_argument("--cache-dir", default=None,
+                        help="diretorio do cache binario das ratings (implica --cache)")
+
+
+def add_predict_arguments(parser):
+    parser.add_argument("-k", type=int, default=DEFAULT_K,
+                        help="vizinhos usados em cada predicao")
+    parser.add_argument("-o", "--output", default="saida.csv",
+                        help="arquivo de saida com as predicoes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processos usados na predicao (0 usa todos os nucleos)")
+    parser.add_argument("--prediction-cache", type=int, default=0,
+                        help="predicoes guardadas num cache LRU por (usuario, filme); 0 desliga")
+
+
+def read_model_ratings(args):
+    with stage("read", "LEITURA") as record:
+        #   LEITURA DAS RATINGS (CACHE BINARIO OU CSV EM UMA PASSADA) PARA UMA
+        #   MATRIZ ESPARSA USUARIOS x FILMES COM IDS CODIFICADOS EM INDICES
+        #_______________________________________________________________________
+        cache_dir = None
+        if args.cache or args.cache_dir is not None or getattr(args, "convert", False):
+            cache_dir = args.cache_dir if args.cache_dir is not None else default_cache_dir(args.ratings)
+        RatingMatrix, user_map, mov_map = load_ratings(args.ratings, cache_dir)
+        record['items'] = RatingMatrix.nnz
+    return RatingMatrix, user_map, mov_map
+
+
+def fit_model(args):
+    NormRating, user_map, mov_map = read_model_ratings(args)
+
+    return fit_engine(NormRating, user_map, mov_map, args)
+
+
+def fit_engine(RatingMatrix, user_map, mov_map, args):
+    if args.engine == 'mf':
+        with stage("factorization", "FATORACAO (ALS)", items=RatingMatrix.nnz):
+            return fit_factors(RatingMatrix, user_map, mov_map, n_factors=args.factors, iterations=args.iterations,
+                               reg=args.reg, workers=args.threads)
+
+    with stage("similarity", "CALCULO DAS SIMILARIDADES") as record:
+        #          CALCULO DAS SIMILARIDADES E INDICE DOS TOP-N VIZINHOS
+        #_______________________________________________________________________
+        model = fit(RatingMatrix, user_map, mov_map, n_neighbours=args.neighbours,
+                    block_size=args.block_size, memory_mb=args.memory_mb,
+                    ann=args.ann, ann_tables=args.ann_tables, ann_bits=args.ann_bits, mode=args.mode,
+                    similarity=args.similarity, compact=args.compact, min_common=args.min_common,
+                    shrinkage=args.shrinkage, min_similarity=args.min_similarity)
+        record['items'] = model.Neighbours.shape[0]
+        print("  %d similaridades no indice de vizinhos"%model.Neighbours.nnz)
+    return model
+
+
+@contextmanager
+def open_predictor(model, args, model_dir=None):
+    # um so preditor para todos os blocos de targets: com --workers o modelo e gravado (se
+    # ainda nao estiver em disco) e a pool de processos aberta uma unica vez
+    if args.workers == 1:
+        yield model
+        return
+    with parallel_model(model, args.workers, model_dir) as predictor:
+        yield predictor
+
+
+def score_targets(model, args, model_dir=None):
+    with stage("predict", "PROCESSAMENTO DAS RECOMENDACOES") as record:
+        #        LEITURA DOS TARGETS E PROCESSAMENTO DAS RECOMENDACOES
+        #_______________________________________________________________________
+        # cada bloco de targets e previsto e gravado antes de ler o proximo; o cache de
+        # predicoes fica no processo principal, e so os pares ausentes vao para os workers
+        record['items'] = 0
+        with PredictionWriter(args.output) as writer, open_predictor(model, args, model_dir) as predictor:
+            if args.prediction_cache > 0:
+                predictor = CachedModel(predictor, prediction_cache=args.prediction_cache, neighbourhood_cache=0)
+            for lines, users_rec, movs_rec in iter_targets(args.targets):
+                writer.write(lines, predictor.predict(users_rec, movs_rec, k=args.k))
+                record['items'] += users_rec.shape[0]
+    if args.prediction_cache > 0:
+        cache = predictor.cache_stats()['predictions']
+        print("  cache de predicoes: %d acertos, %d erros"%(cache['hits'], cache['misses']))
+
+
+def add_out_of_core_arguments(parser):
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="monta o modelo direto em disco, lendo as ratings em blocos (bases maiores que a RAM)")
+
+
+def check_out_of_core(parser, args):
+    if args.out_of_core and (args.engine != "knn" or args.mode != "user" or args.similarity != "cosine"
+                             or args.ann or args.cache or args.cache_dir is not None):
+        parser.error("--out-of-core so vale para o modelo user-based por cosseno com busca exata, sem --cache")
+
+
+def fit_out_of_core_model(args, model_dir):
+    with stage("out-of-core", "MODELO EM DISCO (LEITURA, NORMAS E SIMILARIDADES POR BLOCOS)"):
+        fit_out_of_core(args.ratings, model_dir, MODEL_VERSION, n_neighbours=args.neighbours,
+                        block_size=args.block_size, memory_mb=args.memory_mb, compact=args.compact,
+                        min_common=args.min_common, shrinkage=args.shrinkage, min_similarity=args.min_similarity)
+
+
+def run_fit(argv):
+    parser = argparse.ArgumentParser(prog="main.py fit",
+                                     description="ajusta o modelo user-based e grava em disco")
+    parser.add_argument("ratings")
+    parser.add_argument("model_dir")
+    add_fit_arguments(parser)
+    add_out_of_core_arguments(parser)
+    args = parse_args(parser, argv)
+    check_out_of_core(parser, args)
+
+    if args.out_of_core:
+        fit_out_of_core_model(args, args.model_dir)
+        return
+    model = fit_model(args)
+    with stage("save", "GRAVACAO DO MODELO"):
+        save_model(model, args.model_dir)
+
+
+def run_predict(argv):
+    parser = argparse.ArgumentParser(prog="main.py predict",
+                                     description="preve os targets com um modelo gravado por 'fit'")
+    parser.add_argument("model_dir")
+    parser.add_argument("targets")
+    add_predict_arguments(parser)
+    args = parse_args(parser, argv)
+
+    with stage("load", "CARREGAMENTO DO MODELO"):
+        model = load_model(args.model_dir)
+    score_targets(model, args, model_dir=args.model_dir)
+
+
+def run_recommend(argv):
+    parser = argparse.ArgumentParser(prog="main.py recommend",
+                                     description="top-n filmes para cada usuario de uma lista, com um modelo gravado")
+    parser.add_argument("model_dir")
+    parser.add_argument("users", help="arquivo com um id de usuario (uXXXXXXX) por linha")
+    parser.add_argument("-n", type=int, default=DEFAULT_TOP_N,
+                        help="filmes recomendados por usuario")
+    parser.add_argument("-k", type=int, default=DEFAULT_K,
+                        help="vizinhos usados em cada predicao")
+    parser.add_argument("--min-support", type=int, default=1,
+                        help="minimo de vizinhos (ou filmes avaliados) ligados a um candidato")
+    parser.add_argument("--support-shrinkage", type=float, default=DEFAULT_SUPPORT_SHRINKAGE,
+                        help="encolhe a nota de cada candidato para a media do usuario conforme o suporte s: "
+                             "(s * nota + x * media) / (s + x); 0 desliga")
+    parser.add_argument("-o", "--output", default="recomendacoes.csv",
+                        help="arquivo de saida com as recomendacoes")
+    args = parse_args(parser, argv)
+
+    with stage("load", "CARREGAMENTO DO MODELO"):
+        model = load_model(args.model_dir)
+        users = read_user_ids(args.users)
+
+    with stage("recommend", "GERACAO DAS RECOMENDACOES", items=users.shape[0]):
+        results = recommend_batch(model, users, n=args.n, k=args.k, min_support=args.min_support,
+                                  shrinkage=args.support_shrinkage)
+        write_recommendations(args.output, users, results)
+
+
+def run_serve(argv):
+    parser = argparse.ArgumentParser(prog="main.py serve",
+                                     description="servidor HTTP local de predicoes com o modelo em memoria")
+    parser.add_argument("model_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-k", type=int, default=DEFAULT_K,
+                        help="vizinhos usados em cada predicao")
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_BATCH_WINDOW_MS,
+                        help="espera maxima para juntar requisicoes /predict num lote")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                        help="pares maximos por lote de predicao")
+    parser.add_argument("--prediction-cache", type=int, default=DEFAULT_PREDICTION_CACHE,
+                        help="predicoes guardadas no cache LRU por (usuario, filme)")
+    parser.add_argument("--neighbourhood-cache", type=int, default=DEFAULT_NEIGHBOURHOOD_CACHE,
+                        help="vizinhancas pontuadas (candidatos do top-N) guardadas por usuario")
+    args = parse_args(parser, argv)
+
+    with stage("load", "CARREGAMENTO DO MODELO"):
+        model = load_model(args.model_dir)
+    with stage("serve", "SERVIDOR"):
+        serve(model, host=args.host, port=args.port, k=args.k,
+              window_ms=args.batch_window_ms, max_batch=args.max_batch,
+              prediction_cache=args.prediction_cache, neighbourhood_cache=args.neighbourhood_cache)
+
+
+def run_update(argv):
+    parser = argparse.ArgumentParser(prog="main.py update",
+                                     description="incorpora novas ratings a um modelo gravado por 'fit'")
+    parser.add_argument("model_dir")
+    parser.add_argument("delta", help="arquivo de ratings novas (mesmo formato das ratings)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="diretorio do modelo atualizado (padrao: substitui model_dir)")
+    parser.add_argument("--block-size", type=int, default=None,
+                        help="usuarios por bloco no calculo das similaridades")
+    parser.add_argument("--memory-mb", type=float, default=None,
+                        help="memoria maxima por bloco de similaridades (define o block-size)")
+    args = parse_args(parser, argv)
+
+    with stage("load", "CARREGAMENTO DO MODELO"):
+        model = load_model(args.model_dir)
+    if model.mode != 'user':
+        parser.error(UPDATE_ERROR)
+
+    with stage("read", "LEITURA DAS NOVAS RATINGS") as record:
+        users, movs, grades = read_ratings(args.delta)
+        record['items'] = users.shape[0]
+        print("  %d ratings novas"%users.shape[0])
+
+    with stage("update", "ATUALIZACAO DAS SIMILARIDADES", items=users.shape[0]):
+        model = update(model, users, movs, grades, block_size=args.block_size, memory_mb=args.memory_mb)
+
+    with stage("save", "GRAVACAO DO MODELO"):
+        if args.output is None:
+            replace_model(model, args.model_dir)
+        else:
+            save_model(model, args.output)
+
+
+def run_ann_report(argv):
+    parser = argparse.ArgumentParser(prog="main.py ann-report",
+                                     description="recall@k dos vizinhos aproximados (LSH) contra a busca exata")
+    parser.add_argument("ratings")
+    parser.add_argument("--tables", type=int, nargs="+", default=[4, 8, 16, 32],
+                        help="numeros de tabelas de hash a comparar")
+    parser.add_argument("--ann-bits", type=int, default=DEFAULT_BITS,
+                        help="hiperplanos por tabela")
+    parser.add_argument("--neighbours", type=int, default=DEFAULT_NEIGHBOURS,
+                        help="vizinhos guardados por usuario no indice")
+    parser.add_argument("-k", type=int, default=DEFAULT_K,
+                        help="tamanho do top-k comparado")
+    parser.add_argument("--sample", type=int, default=1000,
+                        help="usuarios amostrados para o calculo do recall")
+    add_cache_arguments(parser)
+    args = parse_args(parser, argv)
+
+    NormRating, user_map, mov_map = read_model_ratings(args)
+    with stage("ann-report", "COMPARACAO LSH x EXATO"):
+        report = recall_report(NormRating, args.neighbours, args.tables, n_bits=args.ann_bits,
+                               k=args.k, sample=args.sample)
+    print("  %-6s %7s %5s %10s %10s"%("modo", "tabelas", "bits", "recall@%d"%args.k, "segundos"))
+    for row in report:
+        print("  %-6s %7s %5s %10.4f %10.2f"%(row['mode'], row.get('tables', '-'), row.get('bits', '-'),
+                                           row['recall'], row['seconds']))
+
+
+def run_evaluate(argv):
+    parser = argparse.ArgumentParser(prog="main.py evaluate",
+                                     description="separa treino/holdout, ajusta o modelo no treino e mede RMSE/MAE "
+                                                 "do holdout para cada k")
+    parser.add_argument("ratings")
+    parser.add_argument("--holdout", type=float, default=DEFAULT_HOLDOUT,
+                        help="fracao das ratings separada para avaliacao")
+    parser.add_argument("--split", choices=("random", "user"), default="random",
+                        help="holdout sorteado entre todas as ratings ou a mesma fracao de cada usuario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-k", type=int, nargs="+", default=[DEFAULT_K],
+                        help="valores de k comparados (ex.: -k 10 20 30 50)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processos usados na predicao (0 usa todos os nucleos)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="grava o resultado tambem em JSON")
+    add_fit_arguments(parser)
+    args = parse_args(parser, argv)
+
+    with stage("split", "SEPARACAO TREINO/HOLDOUT") as record:
+        users, movs, grades = read_ratings(args.ratings)
+        train, test = holdout_split(users, movs, grades, fraction=args.holdout,
+                                    per_user=args.split == "user", seed=args.seed)
+        record['items'] = users.shape[0]
+        print("  %d ratings de treino, %d de holdout"%(train[0].shape[0], test[0].shape[0]))
+
+    model = fit_engine(*build_rating_matrix(*train), args)
+
+    with stage("evaluate", "AVALIACAO DO HOLDOUT", items=test[0].shape[0] * len(args.k)):
+        results = evaluate(model, *test, ks=args.k, workers=args.workers)
+    print("  %5s %-10s %9s %8s %8s %12s"%("k", "segmento", "pares", "rmse", "mae", "pred/s"))
+    for row in results:
+        print("  %5d %-10s %9d %8.4f %8.4f %12.0f"%(row['k'], "total", row['count'], row['rmse'], row['mae'],
+                                                  row['predictions_per_second']))
+        for name in SEGMENTS:
+            seg = row['segments'][name]
+            if seg['count']:
+                print("  %5s %-10s %9d %8.4f %8.4f"%("", name, seg['count'], seg['rmse'], seg['mae']))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({'holdout': args.holdout, 'split': args.split, 'seed': args.seed, 'mode': args.mode,
+                       'engine': args.engine, 'similarity': args.similarity, 'neighbours': args.neighbours,
+                       'ann': args.ann,
+                       'results': results}, f, indent=2)
+
+
+def run_compact_report(argv):
+    parser = argparse.ArgumentParser(prog="main.py compact-report",
+                                     description="compara o modelo em precisao cheia com o armazenamento compacto: "
+                                                 "memoria de cada estrutura e desvio das predicoes dos targets")
+    parser.add_argument("ratings")
+    parser.add_argument("targets")
+    parser.add_argument("-k", type=int, default=DEFAULT_K,
+                        help="vizinhos usados em cada predicao")
+    parser.add_argument("-o", "--output", default=None,
+                        help="grava o resultado tambem em JSON")
+    add_fit_arguments(parser)
+    args = parse_args(parser, argv)
+    if args.engine != "knn" or args.compact is not None:
+        parser.error("compact-report compara o modelo de vizinhos em precisao cheia (sem --engine mf/--compact)")
+
+    model = fit_model(args)
+    with stage("read_targets", "LEITURA DOS TARGETS") as record:
+        _, users, movs = read_targets(args.targets)
+        record['items'] = users.shape[0]
+    with stage("compact", "COMPARACAO DO ARMAZENAMENTO COMPACTO", items=users.shape[0]):
+        rows = compact_report(model, users, movs, k=args.k)
+    print("  %-8s %10s %10s %8s %11s %10s %10s %10s %9s"%("tipo", "total MB", "vizinhos", "viz. MB", "economia",
+                                                          "desvio max", "medio", "rmse", "mudaram"))
+    for row in rows:
+        drift = row['drift']
+        print("  %-8s %10.1f %10d %8.1f %10.1f%% %10.4f %10.6f %10.6f %9d"%(
+            row['storage'], row['bytes']['total'] / 2.0 ** 20, row['neighbours'],
+            row['bytes']['Neighbours'] / 2.0 ** 20, 100 * row['saved'], drift['max_abs'] or 0,
+            drift['mean_abs'] or 0, drift['rmse'] or 0, drift['changed']))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({'mode': args.mode, 'similarity': args.similarity, 'neighbours': args.neighbours,
+                       'ann': args.ann, 'k': args.k, 'results': rows}, f, indent=2)
+
+
+def run_bench(argv):
+    parser = argparse.ArgumentParser(prog="main.py bench",
+                                     description="gera dados sinteticos, mede cada etapa do pipeline e grava um "
+                                                 "relatorio JSON para comparar versoes")
+    parser.add_argument("--data-dir", default="bench_data",
+                        help="diretorio dos ratings.csv/targets.csv sinteticos")
+    parser.add_argument("--ratings", default=None,
+                        help="usa estas ratings em vez de gerar dados sinteticos (exige --targets)")
+    parser.add_argument("--targets", default=None)
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--items", type=int, default=DEFAULT_ITEMS)
+    parser.add_argument("--density", type=float, default=DEFAULT_DENSITY,
+                        help="fracao da matriz usuarios x filmes com rating")
+    parser.add_argument("--n-targets", type=int, default=DEFAULT_TARGETS)
+    parser.add_argument("--skew", type=float, default=DEFAULT_SKEW,
+                        help="expoente da lei de potencia da popularidade dos filmes")
+    parser.add_argument("--cold", type=float, default=DEFAULT_COLD,
+                        help="fracao dos targets com usuario ou filme fora das ratings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--neighbours", type=int, default=DEFAULT_NEIGHBOURS)
+    parser.add_argument("--block-size", type=int, default=None)
+    parser.add_argument("--memory-mb", type=float, default=None)
+    parser.add_argument("-k", type=int, default=DEFAULT_K)
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="relatorio JSON com tempo, pico de RSS e vazao de cada etapa")
+    args = parse_args(parser, argv)
+
+    if args.ratings is not None:
+        if args.targets is None:
+            parser.error("--ratings exige --targets")
+        ratings, targets, dataset = args.ratings, args.targets, {'ratings_file': args.ratings,
+                                                                 'targets_file': args.targets}
+    else:
+        with stage("generate", "GERACAO DOS DADOS"):
+            ratings, targets, dataset = generate_dataset(args.data_dir, n_users=args.users, n_items=args.items,
+                                                         density=args.density, n_targets=args.n_targets,
+                                                         skew=args.skew, cold=args.cold, seed=args.seed)
+    with stage("bench", "BENCHMARK"):
+        stages = run_benchmark(ratings, targets, os.path.join(os.path.dirname(targets), "saida_bench.csv"),
+                               n_neighbours=args.neighbours, k=args.k,
+                               block_size=args.block_size, memory_mb=args.memory_mb,
+                               profiler=Profiler(log=args.profile_log, trace_memory=args.trace_memory,
+                                                 profile_stage=args.profile_stage,
+                                                 profile_output=args.profile_output, echo=False))
+    params = {'neighbours': args.neighbours, 'k': args.k, 'block_size': args.block_size,
+              'memory_mb': args.memory_mb}
+    write_report(args.output, benchmark_report(stages, dataset, params))
+    print("  relatorio gravado em %s" % args.output)
+
+
+def run_all(argv):
+    # modo original: python main.py ratings.csv targets.csv
+    parser = argparse.ArgumentParser(prog="main.py",
+                                     description="subcomandos: fit, predict, recommend, serve, update, ann-report, bench, evaluate "
+                                                 "(ou ratings e targets direto)")
+    parser.add_argument("ratings")
+    parser.add_argument("targets", nargs="?")
+    parser.add_argument("--convert", action="store_true",
+                        help="apenas converte as ratings para o cache binario e sai")
+    add_fit_arguments(parser)
+    add_predict_arguments(parser)
+    add_out_of_core_arguments(parser)
+    parser.add_argument("--work-dir", default=None,
+                        help="diretorio do modelo em disco do --out-of-core (padrao: <ratings>.ooc)")
+    args = parse_args(parser, argv)
+    if args.targets is None and not args.convert:
+        parser.error("o arquivo de targets e obrigatorio (exceto com --convert)")
+    check_out_of_core(parser, args)
+
+    if args.convert:
+        read_model_ratings(args)
+        return
+    if args.out_of_core:
+        model_dir = args.work_dir if args.work_dir is not None else args.ratings + ".ooc"
+        fit_out_of_core_model(args, model_dir)
+        score_targets(load_model(model_dir), args, model_dir=model_dir)
+        return
+    score_targets(fit_model(args), args)
+
+
+COMMANDS = {"fit": run_fit, "predict": run_predict, "recommend": run_recommend, "serve": run_serve,
+            "update": run_update, "ann-report": run_ann_report, "bench": run_bench,
+            "evaluate": run_evaluate, "compact-report": run_compact_report}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        run_all(sys.argv[1:])
+    print("Tempo Final: %.2f seconds" % (time.time() - start_time))
@@ -0,0 +1,214 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from scipy import sparse
+
+from ann import DEFAULT_BITS, DEFAULT_TABLES, lsh_neighbours
+from factorization import load_factor_model, save_factor_model
+from prediction import (DEFAULT_K, FallbackTables, column_index, fallback_tables, lookup_entries, predict_batch,
+                        rating_keys, update_fallback_tables)
+from rating_cache import load_array, load_csr, save_array, save_csr
+from similarity import (DEFAULT_NEIGHBOURS, SimilarityFilter, blocked_cosine_similarity, dequantize_similarities,
+                        quantize_similarities, update_neighbours)
+from sparse_ratings import (IdIndex, center_columns, center_rows, compact_grades, last_rating_per_pair, merge_ratings,
+                            row_norms)
+
+MODEL_VERSION = 4
+TABLE_ARRAYS = ('user_sums', 'user_counts', 'mov_sums', 'mov_counts')
+UPDATE_ERROR = "update incremental disponivel apenas para o modelo user-based; use fit"
+
+
+class Model:
+    # modelo ajustado: ratings, indice de vizinhos e mapas de ids. No modo 'item' os vizinhos
+    # sao filmes x filmes e a predicao roda a mesma rotina sobre a matriz transposta
+
+    def __init__(self, RatingMatrix, Neighbours, user_map, mov_map, meta=None,
+                 RatingCsc=None, keys=None, neighbour_keys=None, norms=None, tables=None):
+        self.RatingMatrix = RatingMatrix
+        self.Neighbours = Neighbours
+        self.user_map = user_map
+        self.mov_map = mov_map
+        self.meta = meta if meta is not None else {}
+        self.mode = self.meta.get('mode', 'user')
+        # estruturas auxiliares da predicao, calculadas uma vez e gravadas junto. O modelo
+        # compacto nao guarda as chaves int64 (8 bytes por nota e por vizinho): a predicao
+        # busca cada par dentro da linha do CSR
+        self.RatingCsc = RatingCsc if RatingCsc is not None else column_index(RatingMatrix)
+        compact = 'compact' in self.meta
+        if keys is None and not compact:
+            keys = rating_keys(RatingMatrix if self.mode == 'user' else self.RatingCsc.T)
+        self.keys = keys
+        if neighbour_keys is None and not compact:
+            neighbour_keys = rating_keys(Neighbours)
+        self.neighbour_keys = neighbour_keys
+        if norms is None:
+            Rows = RatingMatrix if self.mode == 'user' else self.RatingCsc.T.tocsr()
+            norms = row_norms(similarity_rows(Rows, self.mode, self.meta.get('similarity', 'cosine')))
+        self.norms = norms
+        self.tables = tables if tables is not None else fallback_tables(RatingMatrix)
+        if self.mode == 'item':
+            self.item_tables = FallbackTables(self.tables.mov_sums, self.tables.mov_counts,
+                                              self.tables.user_sums, self.tables.user_counts)
+
+    def predict(self, users_rec, movs_rec, k=DEFAULT_K):
+        if self.mode == 'item':
+            # papeis trocados: "usuarios" sao os filmes e os vizinhos sao filmes parecidos
+            # avaliados pelo usuario; sem vizinhos, a reserva continua sendo a media do filme
+            return predict_batch(movs_rec, users_rec, self.RatingCsc.T, self.Neighbours,
+                                 self.mov_map, self.user_map, k=k, RatingCsc=self.RatingMatrix.T,
+                                 keys=self.keys, neighbour_keys=self.neighbour_keys, tables=self.item_tables,
+                                 empty_fallback='user', search=self.keys is None)
+        return predict_batch(users_rec, movs_rec, self.RatingMatrix, self.Neighbours,
+                             self.user_map, self.mov_map, k=k, RatingCsc=self.RatingCsc,
+                             keys=self.keys, neighbour_keys=self.neighbour_keys, tables=self.tables,
+                             search=self.keys is None)
+
+
+def similarity_rows(Rows, mode, similarity):
+    # linhas usadas no cosseno: notas cruas ('cosine'), centralizadas pela media da propria
+    # linha ('pearson') ou pela media do usuario ('adjusted', o cosseno ajustado do item-based;
+    # no modo user coincide com pearson)
+    if similarity == 'cosine':
+        return Rows
+    if similarity == 'adjusted' and mode == 'item':
+        return center_columns(Rows)
+    return center_rows(Rows)
+
+
+def similarity_filter(meta):
+    # filtros gravados no modelo, reaplicados pelo update; os centralizados so guardam
+    # correlacoes positivas
+    return SimilarityFilter(meta.get('min_common', 1), meta.get('shrinkage', 0.0), meta.get('min_similarity'),
+                            positive_only=meta.get('similarity', 'cosine') != 'cosine')
+
+
+def fit(RatingMatrix, user_map, mov_map, n_neighbours=DEFAULT_NEIGHBOURS, block_size=None, memory_mb=None,
+        ann=False, ann_tables=DEFAULT_TABLES, ann_bits=DEFAULT_BITS, mode='user', similarity='cosine',
+        compact=None, min_common=1, shrinkage=0.0, min_similarity=None):
+    # ann=True troca a busca exata (todos os pares) pelos vizinhos aproximados do LSH;
+    # mode='item' calcula as similaridades entre filmes (linhas da matriz transposta);
+    # compact ('float16' ou 'int8') guarda as notas em uint8 e as similaridades nesse tipo;
+    # min_common, shrinkage e min_similarity filtram os vizinhos durante o calculo
+    if compact is not None:
+        RatingMatrix = compact_grades(RatingMatrix)
+    RatingCsc = column_index(RatingMatrix)
+    Rows = RatingMatrix if mode == 'user' else RatingCsc.T.tocsr()
+    Rows = similarity_rows(Rows, mode, similarity)
+    norms = row_norms(Rows)
+    meta = {'n_neighbours': n_neighbours, 'similarity': similarity, 'min_common': min_common,
+            'shrinkage': shrinkage, 'min_similarity': min_similarity}
+    filters = similarity_filter(meta)
+    if ann:
+        Neighbours = lsh_neighbours(Rows, n_neighbours, n_tables=ann_tables, n_bits=ann_bits, norms=norms,
+                                    filters=filters)
+        Neighbours = quantize_similarities(Neighbours, compact)
+        meta.update(search='lsh', ann_tables=ann_tables, ann_bits=ann_bits)
+    else:
+        Neighbours = blocked_cosine_similarity(Rows, block_size=block_size, memory_mb=memory_mb,
+                                               n_neighbours=n_neighbours, norms=norms, filters=filters,
+                                               sim_dtype=compact)
+        meta['search'] = 'exact'
+    meta['mode'] = mode
+    if compact is not None:
+        meta['compact'] = compact
+    return Model(RatingMatrix, Neighbours, user_map, mov_map, meta, RatingCsc=RatingCsc, norms=norms)
+
+
+def update(model, users, movs, grades, block_size=None, memory_mb=None):
+    # incorpora um lote de ratings novas sem refazer todas as similaridades: so os usuarios
+    # do lote tem norma e similaridades recalculadas
+    if model.mode != 'user':
+        raise ValueError(UPDATE_ERROR)
+    users, movs, grades = last_rating_per_pair(users, movs, grades)
+    RatingMatrix, user_map, mov_map, user_pos, affected = merge_ratings(
+        model.RatingMatrix, model.user_map, model.mov_map, users, movs, grades)
+    mov_pos = mov_map.lookup(model.mov_map.ids)[0]
+
+    # nota anterior de cada par do lote, para ajustar as medias sem varrer as ratings
+    old_user, known_user = model.user_map.lookup(users)
+    old_mov, known_mov = model.mov_map.lookup(movs)
+    found, old_grades = lookup_entries(model.RatingMatrix, model.keys, old_user, old_mov)
+    old_grades = np.where(found & known_user & known_mov, old_grades, 0)
+    tables = update_fallback_tables(model.tables, user_pos, mov_pos, RatingMatrix.shape,
+                                    user_map.lookup(users)[0], mov_map.lookup(movs)[0], grades, old_grades)
+
+    # pearson/adjusted: so as linhas dos afetados mudam de media, entao as normas e
+    # similaridades dos demais continuam valendo
+    similarity = model.meta.get('similarity', 'cosine')
+    Rows = similarity_rows(RatingMatrix, 'user', similarity)
+    norms = np.zeros(RatingMatrix.shape[0], dtype='float32')
+    norms[user_pos] = model.norms
+    norms[affected] = row_norms(Rows[affected])
+
+    # modelo compacto: as contas do update rodam em float32 e o resultado volta a ser compactado
+    compact = model.meta.get('compact')
+    Old = (model.Neighbours if compact is None else dequantize_similarities(model.Neighbours)).tocoo()
+    Neighbours = sparse.csr_matrix((Old.data, (user_pos[Old.row], user_pos[Old.col])),
+                                   shape=(RatingMatrix.shape[0], RatingMatrix.shape[0]), dtype='float32')
+    Neighbours = update_neighbours(Neighbours, Rows, norms, affected, model.meta.get('n_neighbours'),
+                                   block_size=block_size, memory_mb=memory_mb,
+                                   filters=similarity_filter(model.meta))
+    if compact is not None:
+        RatingMatrix = compact_grades(RatingMatrix)
+        Neighbours = quantize_similarities(Neighbours, compact)
+    meta = dict(model.meta, updates=model.meta.get('updates', 0) + 1)
+    return Model(RatingMatrix, Neighbours, user_map, mov_map, meta, norms=norms, tables=tables)
+
+
+def save_model(model, model_dir):
+    if model.mode == 'mf':
+        save_factor_model(model, model_dir, MODEL_VERSION)
+        return
+    os.makedirs(model_dir, exist_ok=True)
+    save_csr(model_dir, model.RatingMatrix, prefix='ratings_')
+    save_csr(model_dir, model.Neighbours, prefix='neighbours_')
+    save_csr(model_dir, model.RatingCsc, prefix='ratings_csc_')
+    if model.keys is not None:
+        save_array(model_dir, 'rating_keys', model.keys)
+        save_array(model_dir, 'neighbour_keys', model.neighbour_keys)
+    save_array(model_dir, 'norms', model.norms)
+    for name in TABLE_ARRAYS:
+        save_array(model_dir, name, getattr(model.tables, name))
+    save_array(model_dir, 'user_ids', model.user_map.ids)
+    save_array(model_dir, 'mov_ids', model.mov_map.ids)
+
+    meta = dict(model.meta, version=MODEL_VERSION, shape=list(model.RatingMatrix.shape))
+    with open(os.path.join(model_dir, "model.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_model(model_dir):
+    # todos os arrays sao abertos com mmap: carregar o modelo nao copia nada para a memoria
+    with open(os.path.join(model_dir, "model.json")) as f:
+        meta = json.load(f)
+    if meta.get('version') != MODEL_VERSION:
+        raise ValueError("modelo em %s tem versao %s, esperada %d" % (model_dir, meta.get('version'), MODEL_VERSION))
+    if meta.get('engine') == 'mf':
+        return load_factor_model(model_dir, meta)
+
+    num_rows = meta['shape'][0] if meta.get('mode', 'user') == 'user' else meta['shape'][1]
+    RatingMatrix = load_csr(model_dir, meta['shape'], prefix='ratings_')
+    Neighbours = load_csr(model_dir, (num_rows, num_rows), prefix='neighbours_')
+    user_map = IdIndex(load_array(model_dir, 'user_ids'))
+    mov_map = IdIndex(load_array(model_dir, 'mov_ids'))
+    RatingCsc = load_csr(model_dir, meta['shape'], prefix='ratings_csc_', fmt=sparse.csc_matrix)
+    keys = neighbour_keys = None
+    if 'compact' not in meta:
+        keys, neighbour_keys = load_array(model_dir, 'rating_keys'), load_array(model_dir, 'neighbour_keys')
+    return Model(RatingMatrix, Neighbours, user_map, mov_map, meta, RatingCsc=RatingCsc,
+                 keys=keys, neighbour_keys=neighbour_keys,
+                 norms=load_array(model_dir, 'norms'),
+                 tables=FallbackTables(*(load_array(model_dir, name) for name in TABLE_ARRAYS)))
+
+
+def replace_model(model, model_dir):
+    # o modelo carregado continua mapeado nos arquivos antigos: grava ao lado e troca o diretorio
+    tmp_dir = model_dir.rstrip(os.sep) + ".tmp"
+    old_dir = model_dir.rstrip(os.sep) + ".old"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    save_model(model, tmp_dir)
+    os.replace(model_dir, old_dir)
+    os.replace(tmp_dir, model_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
@@ -0,0 +1,308 @@
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+from prediction import MAX_CHUNK_ENTRIES, chunk_bounds
+from rating_cache import save_array
+from ratings_io import CHUNK_BYTES, iter_chunks, parse_chunk
+from similarity import DEFAULT_NEIGHBOURS, SimilarityFilter, keep_top_n, quantize_similarities, resolve_block_size
+from sparse_ratings import IdIndex, compact_grade_values, rating_indicator
+
+# modo fora da memoria: as ratings passam em blocos do CSV para arrays .npy mapeados em
+# disco, ja com os nomes de arquivo do modelo gravado; normas, indice transposto, chaves,
+# tabelas de reserva e vizinhos sao calculados por blocos de linhas. Em memoria ficam
+# apenas os ids, contagens por usuario/filme e um bloco de cada vez
+
+
+def open_array(directory, name, dtype, length):
+    return np.lib.format.open_memmap(os.path.join(directory, name + ".npy"), mode='w+', dtype=dtype,
+                                     shape=(int(length),))
+
+
+def shrink_array(directory, name, length):
+    # regrava o .npy com apenas os primeiros length itens (pares repetidos ou nota 0 removidos)
+    path = os.path.join(directory, name + ".npy")
+    old = np.load(path, mmap_mode='r')
+    if old.shape[0] == length:
+        return
+    new = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=old.dtype, shape=(int(length),))
+    for start in range(0, length, MAX_CHUNK_ENTRIES):
+        end = min(start + MAX_CHUNK_ENTRIES, length)
+        new[start:end] = old[start:end]
+    new.flush()
+    del new, old
+    os.replace(path + ".tmp", path)
+
+
+def row_blocks(indptr):
+    return chunk_bounds(np.diff(np.asarray(indptr)))
+
+
+def scan_ids(fname, chunk_bytes=CHUNK_BYTES):
+    # primeira passada: ids de usuarios e filmes e o numero de ratings de cada usuario
+    user_ids, user_counts, mov_ids = [], [], []
+    for buf in iter_chunks(fname, chunk_bytes):
+        users, movs, _ = parse_chunk(buf)
+        ids, counts = np.unique(users.astype('int32'), return_counts=True)
+        user_ids.append(ids)
+        user_counts.append(counts)
+        mov_ids.append(np.unique(movs.astype('int32')))
+    if len(user_ids) == 0:
+        return np.zeros(0, dtype='int32'), np.zeros(0, dtype='int64'), np.zeros(0, dtype='int32')
+    ids, pos = np.unique(np.concatenate(user_ids), return_inverse=True)
+    counts = np.bincount(pos, weights=np.concatenate(user_counts), minlength=ids.shape[0]).astype('int64')
+    return ids, counts, np.unique(np.concatenate(mov_ids))
+
+
+def scatter_rows(rows, cols, values, cursor, indices, data):
+    # grava cada entrada na proxima posicao livre da sua linha (ordem do arquivo mantida)
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    first = np.searchsorted(rows, rows, side='left')
+    dest = cursor[rows] + (np.arange(rows.shape[0]) - first)
+    indices[dest] = cols[order]
+    data[dest] = values[order]
+    cursor += np.bincount(rows, minlength=cursor.shape[0])
+
+
+def compact_rows(directory, prefix, indptr):
+    # ordena as colunas de cada linha, fica com a ultima nota (na ordem do arquivo) dos pares
+    # repetidos e tira notas 0, como o build_rating_matrix; a escrita compactada nunca passa
+    # a frente da leitura
+    indices = np.load(os.path.join(directory, prefix + "indices.npy"), mmap_mode='r+')
+    data = np.load(os.path.join(directory, prefix + "data.npy"), mmap_mode='r+')
+    new_indptr = np.zeros_like(indptr)
+    write = 0
+    for start, end in row_blocks(indptr):
+        lo, hi = indptr[start], indptr[end]
+        rows = np.repeat(np.arange(start, end), np.diff(indptr[start:end + 1]))
+        cols, values = np.array(indices[lo:hi]), np.array(data[lo:hi])
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        # o lexsort e estavel e o scatter manteve a ordem do arquivo: a ultima de cada par vence
+        ends = np.concatenate(((rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]), [True]))
+        last = np.flatnonzero(ends[:rows.shape[0]])
+        rows, cols, values = rows[last], cols[last], values[last]
+        keep = values != 0
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        indices[write:write + cols.shape[0]] = cols
+        data[write:write + cols.shape[0]] = values
+        new_indptr[start + 1:end + 1] = write + np.cumsum(np.bincount(rows - start, minlength=end - start))
+        write += cols.shape[0]
+    indices.flush()
+    data.flush()
+    del indices, data
+    shrink_array(directory, prefix + "indices", write)
+    shrink_array(directory, prefix + "data", write)
+    save_array(directory, prefix + "indptr", new_indptr)
+    return new_indptr
+
+
+def disk_csr(directory, prefix, shape, fmt=sparse.csr_matrix):
+    indptr, indices, data = (np.load(os.path.join(directory, prefix + name + ".npy"), mmap_mode='r')
+                             for name in ('indptr', 'indices', 'data'))
+    Matrix = fmt((data, indices, indptr), shape=shape, copy=False)
+    Matrix.has_sorted_indices = True
+    return Matrix
+
+
+def build_disk_ratings(fname, directory, chunk_bytes=CHUNK_BYTES):
+    # segunda passada: espalha as ratings de cada bloco do CSV nas linhas do CSR em disco
+    user_ids, user_counts, mov_ids = scan_ids(fname, chunk_bytes)
+    user_map, mov_map = IdIndex(user_ids), IdIndex(mov_ids)
+    indptr = np.concatenate(([0], np.cumsum(user_counts))).astype('int64')
+    indices = open_array(directory, "ratings_indices", 'int32', indptr[-1])
+    data = open_array(directory, "ratings_data", 'float32', indptr[-1])
+    cursor = indptr[:-1].copy()
+    for buf in iter_chunks(fname, chunk_bytes):
+        users, movs, grades = parse_chunk(buf)
+        scatter_rows(user_map.lookup(users.astype('int32'))[0], mov_map.lookup(movs.astype('int32'))[0],
+                     grades.astype('float32'), cursor, indices, data)
+    indices.flush()
+    data.flush()
+    del indices, data
+    compact_rows(directory, "ratings_", indptr)
+    save_array(directory, "user_ids", user_ids)
+    save_array(directory, "mov_ids", mov_ids)
+    return disk_csr(directory, "ratings_", (user_ids.shape[0], mov_ids.shape[0])), user_map, mov_map
+
+
+def compact_disk_grades(directory, prefix):
+    # troca as notas float32 ja compactadas por uint8, bloco a bloco
+    path = os.path.join(directory, prefix + "data.npy")
+    data = np.load(path, mmap_mode='r')
+    target = open_array(directory, prefix + "data_uint8", 'uint8', data.shape[0])
+    for start in range(0, data.shape[0], MAX_CHUNK_ENTRIES):
+        target[start:start + MAX_CHUNK_ENTRIES] = compact_grade_values(data[start:start + MAX_CHUNK_ENTRIES])
+    target.flush()
+    del data, target
+    os.replace(os.path.join(directory, prefix + "data_uint8.npy"), path)
+
+
+def transpose_to_disk(Matrix, directory, prefix, scale=None):
+    # CSR da transposta (= CSC de Matrix) em disco; scale multiplica cada valor pelo fator
+    # da sua linha original (normalizacao das linhas sem copiar a matriz inteira)
+    counts = np.zeros(Matrix.shape[1], dtype='int64')
+    for start, end in row_blocks(Matrix.indptr):
+        counts += np.bincount(Matrix.indices[Matrix.indptr[start]:Matrix.indptr[end]], minlength=Matrix.shape[1])
+    indptr = np.concatenate(([0], np.cumsum(counts))).astype('int64')
+    indices = open_array(directory, prefix + "indices", 'int32', indptr[-1])
+    data = open_array(directory, prefix + "data", 'float32' if scale is not None else Matrix.data.dtype, indptr[-1])
+    cursor = indptr[:-1].copy()
+    for start, end in row_blocks(Matrix.indptr):
+        lo, hi = Matrix.indptr[start], Matrix.indptr[end]
+        rows = np.repeat(np.arange(start, end, dtype='int32'), np.diff(Matrix.indptr[start:end + 1]))
+        values = np.asarray(Matrix.data[lo:hi])
+        if scale is not None:
+            values = np.nan_to_num(values / scale[rows], copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+        scatter_rows(np.asarray(Matrix.indices[lo:hi]), rows, values, cursor, indices, data)
+    indices.flush()
+    data.flush()
+    del indices, data
+    save_array(directory, prefix + "indptr", indptr)
+    return disk_csr(directory, prefix, (Matrix.shape[1], Matrix.shape[0]))
+
+
+def indicator_on_disk(Matrix, directory, prefix):
+    # mesma estrutura de Matrix com 1 em cada entrada (contagem de notas em comum), gravada em disco
+    data = open_array(directory, prefix + "data", 'float32', Matrix.indptr[-1])
+    for start in range(0, data.shape[0], MAX_CHUNK_ENTRIES):
+        data[start:start + MAX_CHUNK_ENTRIES] = 1
+    data.flush()
+    del data
+    Ind = sparse.csr_matrix((np.load(os.path.join(directory, prefix + "data.npy"), mmap_mode='r'), Matrix.indices,
+                             Matrix.indptr), shape=Matrix.shape, copy=False)
+    Ind.has_sorted_indices = True
+    return Ind
+
+
+def blocked_row_norms(Matrix):
+    norms = np.zeros(Matrix.shape[0], dtype='float32')
+    for start, end in row_blocks(Matrix.indptr):
+        norms[start:end] = np.sqrt(squared_row_sums(Matrix, start, end))
+    return norms
+
+
+def squared_row_sums(Matrix, start, end):
+    lo, hi = Matrix.indptr[start], Matrix.indptr[end]
+    Block = sparse.csr_matrix((np.asarray(Matrix.data[lo:hi], dtype='float32'), np.asarray(Matrix.indices[lo:hi]),
+                               Matrix.indptr[start:end + 1] - lo), shape=(end - start, Matrix.shape[1]))
+    return np.asarray(Block.multiply(Block).sum(axis=1)).ravel()
+
+
+def blocked_fallback_tables(Matrix, directory):
+    user_sums = np.zeros(Matrix.shape[0], dtype='float64')
+    mov_sums = np.zeros(Matrix.shape[1], dtype='float64')
+    mov_counts = np.zeros(Matrix.shape[1], dtype='int64')
+    for start, end in row_blocks(Matrix.indptr):
+        lo, hi = Matrix.indptr[start], Matrix.indptr[end]
+        rows = np.repeat(np.arange(end - start), np.diff(Matrix.indptr[start:end + 1]))
+        grades = np.asarray(Matrix.data[lo:hi], dtype='float64')
+        cols = np.asarray(Matrix.indices[lo:hi])
+        user_sums[start:end] = np.bincount(rows, weights=grades, minlength=end - start)
+        mov_sums += np.bincount(cols, weights=grades, minlength=Matrix.shape[1])
+        mov_counts += np.bincount(cols, minlength=Matrix.shape[1])
+    save_array(directory, "user_sums", user_sums)
+    save_array(directory, "user_counts", np.diff(np.asarray(Matrix.indptr)).astype('int64'))
+    save_array(directory, "mov_sums", mov_sums)
+    save_array(directory, "mov_counts", mov_counts)
+
+
+def blocked_keys(Matrix, directory, name):
+    # mesmas chaves linha * n_colunas + coluna do rating_keys, gravadas por blocos
+    keys = open_array(directory, name, 'int64', Matrix.indptr[-1])
+    for start, end in row_blocks(Matrix.indptr):
+        lo, hi = Matrix.indptr[start], Matrix.indptr[end]
+        rows = np.repeat(np.arange(start, end, dtype='int64'), np.diff(Matrix.indptr[start:end + 1]))
+        keys[lo:hi] = rows * Matrix.shape[1] + Matrix.indices[lo:hi]
+    keys.flush()
+
+
+def disk_similarity(RatingMatrix, NormT, norms, directory, n_neighbours=DEFAULT_NEIGHBOURS,
+                    block_size=None, memory_mb=None, sim_dtype=None, filters=None, IndT=None):
+    # D[bloco] @ D.T com D.T ja normalizada e mapeada em disco; cada bloco filtrado, podado ao
+    # top-N (e compactado, com sim_dtype) vai direto para arquivos crus, convertidos em .npy no fim.
+    # Filtros por notas em comum precisam de IndT, a indicadora transposta em disco
+    data_dtype = sim_dtype or 'float32'
+    if filters is None:
+        filters = SimilarityFilter()
+    num_users = RatingMatrix.shape[0]
+    block_size = resolve_block_size(num_users, block_size, memory_mb, filters.block_products)
+    counts = np.zeros(num_users, dtype='int64')
+    raw = {name: open(os.path.join(directory, "neighbours_%s.raw" % name), "wb") for name in ('indices', 'data')}
+    for start in range(0, num_users, block_size):
+        end = min(start + block_size, num_users)
+        lo, hi = RatingMatrix.indptr[start], RatingMatrix.indptr[end]
+        rows = np.repeat(np.arange(end - start), np.diff(RatingMatrix.indptr[start:end + 1]))
+        values = np.nan_to_num(np.asarray(RatingMatrix.data[lo:hi]) / norms[start + rows], copy=False,
+                               nan=0.0, posinf=0.0, neginf=0.0)
+        D = sparse.csr_matrix((values, np.asarray(RatingMatrix.indices[lo:hi]),
+                               RatingMatrix.indptr[start:end + 1] - lo), shape=(end - start, RatingMatrix.shape[1]))
+        SimBlock = (D @ NormT).tocsr()
+        Common = (rating_indicator(D) @ IndT).tocsr() if filters.uses_common else None
+        SimBlock = keep_top_n(filters.apply(SimBlock, Common), n_neighbours)
+        SimBlock.sort_indices()
+        SimBlock = quantize_similarities(SimBlock, sim_dtype)
+        counts[start:end] = np.diff(SimBlock.indptr)
+        raw['indices'].write(SimBlock.indices.astype('int32').tobytes())
+        raw['data'].write(SimBlock.data.astype(data_dtype).tobytes())
+    for f in raw.values():
+        f.close()
+
+    indptr = np.concatenate(([0], np.cumsum(counts))).astype('int64')
+    for name, dtype in (('indices', 'int32'), ('data', data_dtype)):
+        path = os.path.join(directory, "neighbours_%s.raw" % name)
+        source = np.memmap(path, dtype=dtype, mode='r', shape=(int(indptr[-1]),)) if indptr[-1] else np.zeros(0, dtype)
+        target = open_array(directory, "neighbours_" + name, dtype, indptr[-1])
+        for start in range(0, indptr[-1], MAX_CHUNK_ENTRIES):
+            target[start:start + MAX_CHUNK_ENTRIES] = source[start:start + MAX_CHUNK_ENTRIES]
+        target.flush()
+        del source, target
+        os.remove(path)
+    save_array(directory, "neighbours_indptr", indptr)
+    return disk_csr(directory, "neighbours_", (num_users, num_users))
+
+
+def fit_out_of_core(fname, model_dir, version, n_neighbours=DEFAULT_NEIGHBOURS, block_size=None, memory_mb=None,
+                    chunk_bytes=CHUNK_BYTES, compact=None, min_common=1, shrinkage=0.0, min_similarity=None):
+    # ajusta o modelo user-based (cosseno, busca exata) gravando tudo direto em model_dir,
+    # no mesmo formato do save_model
+    filters = SimilarityFilter(min_common, shrinkage, min_similarity)
+    os.makedirs(model_dir, exist_ok=True)
+    RatingMatrix, user_map, mov_map = build_disk_ratings(fname, model_dir, chunk_bytes)
+    if compact is not None:
+        del RatingMatrix
+        compact_disk_grades(model_dir, "ratings_")
+        RatingMatrix = disk_csr(model_dir, "ratings_", (len(user_map), len(mov_map)))
+    print("  %d ratings em disco (%d usuarios, %d filmes)" % (RatingMatrix.nnz, len(user_map), len(mov_map)))
+    RatingCsc = transpose_to_disk(RatingMatrix, model_dir, "ratings_csc_")
+    norms = blocked_row_norms(RatingMatrix)
+    save_array(model_dir, "norms", norms)
+    blocked_fallback_tables(RatingMatrix, model_dir)
+    if compact is None:
+        # o modelo compacto busca os pares dentro de cada linha, sem as chaves int64
+        blocked_keys(RatingMatrix, model_dir, "rating_keys")
+
+    NormT = transpose_to_disk(RatingMatrix, model_dir, "norm_t_", scale=norms)
+    IndT = indicator_on_disk(NormT, model_dir, "common_t_") if filters.uses_common else None
+    Neighbours = disk_similarity(RatingMatrix, NormT, norms, model_dir, n_neighbours=n_neighbours,
+                                 block_size=block_size, memory_mb=memory_mb, sim_dtype=compact, filters=filters,
+                                 IndT=IndT)
+    del NormT, IndT
+    for name in ('indptr', 'indices', 'data'):
+        os.remove(os.path.join(model_dir, "norm_t_%s.npy" % name))
+    if filters.uses_common:
+        os.remove(os.path.join(model_dir, "common_t_data.npy"))
+    if compact is None:
+        blocked_keys(Neighbours, model_dir, "neighbour_keys")
+    del RatingCsc
+
+    meta = {'n_neighbours': n_neighbours, 'similarity': 'cosine', 'min_common': min_common, 'shrinkage': shrinkage,
+            'min_similarity': min_similarity, 'search': 'exact', 'mode': 'user',
+            'out_of_core': True, 'version': version, 'shape': list(RatingMatrix.shape)}
+    if compact is not None:
+        meta['compact'] = compact
+    with open(os.path.join(model_dir, "model.json"), "w") as f:
+        json.dump(meta, f, indent=1)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from model import load_model, save_model
+from prediction import DEFAULT_K
+
+SHARDS_PER_WORKER = 4
+
+_worker_model = None
+
+
+def _init_worker(model_dir):
+    # cada processo abre o modelo com mmap: as paginas vem do cache do SO, sem copia por worker
+    global _worker_model
+    _worker_model = load_model(model_dir)
+
+
+def _predict_shard(shard):
+    users_rec, movs_rec, k = shard
+    return _worker_model.predict(users_rec, movs_rec, k=k)
+
+
+class ParallelPredictor:
+    # pool de processos aberta uma vez sobre o modelo gravado em model_dir: serve varios lotes
+    # de targets seguidos e cada worker carrega (mapeia) o modelo uma unica vez
+
+    def __init__(self, model_dir, workers=None):
+        self.workers = workers if workers else os.cpu_count()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(model_dir,))
+
+    def predict(self, users_rec, movs_rec, k=DEFAULT_K):
+        # divide os targets em fatias contiguas (mantendo juntos os targets de um mesmo usuario)
+        # e junta os resultados na ordem original
+        n_shards = min(users_rec.shape[0], self.workers * SHARDS_PER_WORKER)
+        if n_shards == 0:
+            return np.zeros(0, dtype='float64')
+        bounds = np.linspace(0, users_rec.shape[0], n_shards + 1).astype('int64')
+        shards = [(users_rec[a:b], movs_rec[a:b], k) for a, b in zip(bounds[:-1], bounds[1:])]
+        return np.concatenate(list(self.pool.map(_predict_shard, shards)))
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def parallel_model(model, workers=None, model_dir=None):
+    # preditor paralelo para um modelo; se ele so existe em memoria, e gravado uma vez num
+    # diretorio temporario para os workers mapearem
+    if model_dir is not None:
+        with ParallelPredictor(model_dir, workers) as predictor:
+            yield predictor
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        save_model(model, tmp_dir)
+        with ParallelPredictor(tmp_dir, workers) as predictor:
+            yield predictor
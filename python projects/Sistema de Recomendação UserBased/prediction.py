@@ -0,0 +1,217 @@
+import numpy as np
+
+DEFAULT_K = 30
+MAX_CHUNK_ENTRIES = 1 << 22
+
+
+class FallbackTables:
+    # somas e contagens de notas por usuario e por filme, calculadas uma vez;
+    # servem todas as predicoes de reserva (usuario frio, filme frio, sem vizinhos, global)
+
+    def __init__(self, user_sums, user_counts, mov_sums, mov_counts):
+        self.user_sums = user_sums
+        self.user_counts = user_counts
+        self.mov_sums = mov_sums
+        self.mov_counts = mov_counts
+        # medias float32, iguais ao np.mean do vetor de notas para notas inteiras
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.user_means = np.asarray(user_sums, dtype='float32') / np.asarray(user_counts, dtype='float32')
+            self.mov_means = np.asarray(mov_sums, dtype='float32') / np.asarray(mov_counts, dtype='float32')
+        total = int(np.sum(user_counts))
+        self.media_global = np.float32(np.sum(user_sums) / total) if total > 0 else np.float32(np.nan)
+
+
+def fallback_tables(RatingMatrix):
+    # uma passada pelas notas do CSR: linhas pelo indptr, colunas pelo bincount
+    rows = np.repeat(np.arange(RatingMatrix.shape[0]), np.diff(RatingMatrix.indptr))
+    grades = np.asarray(RatingMatrix.data, dtype='float64')
+    return FallbackTables(np.bincount(rows, weights=grades, minlength=RatingMatrix.shape[0]),
+                          np.diff(RatingMatrix.indptr).astype('int64'),
+                          np.bincount(RatingMatrix.indices, weights=grades, minlength=RatingMatrix.shape[1]),
+                          np.bincount(RatingMatrix.indices, minlength=RatingMatrix.shape[1]).astype('int64'))
+
+
+def update_fallback_tables(tables, user_pos, mov_pos, shape, ind_user, ind_mov, new_grades, old_grades):
+    # ajusta somas/contagens com um lote de ratings (indices ja no modelo novo); old_grades
+    # e a nota que o par tinha antes (0 se nao existia), nota nova 0 remove o par
+    user_sums = np.zeros(shape[0], dtype='float64')
+    user_counts = np.zeros(shape[0], dtype='int64')
+    mov_sums = np.zeros(shape[1], dtype='float64')
+    mov_counts = np.zeros(shape[1], dtype='int64')
+    user_sums[user_pos], user_counts[user_pos] = tables.user_sums, tables.user_counts
+    mov_sums[mov_pos], mov_counts[mov_pos] = tables.mov_sums, tables.mov_counts
+
+    diff = np.asarray(new_grades, dtype='float64') - old_grades
+    count_diff = (np.asarray(new_grades) != 0).astype('int64') - (np.asarray(old_grades) != 0)
+    np.add.at(user_sums, ind_user, diff)
+    np.add.at(user_counts, ind_user, count_diff)
+    np.add.at(mov_sums, ind_mov, diff)
+    np.add.at(mov_counts, ind_mov, count_diff)
+    return FallbackTables(user_sums, user_counts, mov_sums, mov_counts)
+
+
+def rating_keys(RatingMatrix):
+    # chave linha * n_colunas + coluna de cada nota, ja ordenada pelo CSR
+    rows = np.repeat(np.arange(RatingMatrix.shape[0], dtype='int64'), np.diff(RatingMatrix.indptr))
+    return rows * RatingMatrix.shape[1] + RatingMatrix.indices
+
+
+def lookup_ratings(keys, grades, query):
+    loc = np.searchsorted(keys, query)
+    loc[loc == keys.shape[0]] = 0
+    found = keys[loc] == query if keys.shape[0] > 0 else np.zeros(query.shape[0], dtype=bool)
+    return found, grades[loc] if keys.shape[0] > 0 else np.zeros(query.shape[0], dtype=grades.dtype)
+
+
+def search_rows(Matrix, rows, cols):
+    # busca binaria de cada coluna dentro da sua linha do CSR (colunas ordenadas), vetorizada
+    # sobre as consultas: dispensa as chaves int64 do rating_keys (modelo compacto)
+    if Matrix.indices.shape[0] == 0:
+        return np.zeros(rows.shape[0], dtype=bool), np.zeros(rows.shape[0], dtype=Matrix.data.dtype)
+    lo = np.asarray(Matrix.indptr[rows], dtype='int64')
+    end = np.asarray(Matrix.indptr[rows + 1], dtype='int64')
+    hi = end.copy()
+    last = Matrix.indices.shape[0] - 1
+    for _ in range(int((end - lo).max(initial=0)).bit_length()):
+        mid = (lo + hi) // 2
+        right = (lo < hi) & (Matrix.indices[np.minimum(mid, last)] < cols)
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(right, hi, mid)
+    found = lo < end
+    found[found] = Matrix.indices[lo[found]] == cols[found]
+    values = np.zeros(rows.shape[0], dtype=Matrix.data.dtype)
+    values[found] = Matrix.data[lo[found]]
+    return found, values
+
+
+def lookup_entries(Matrix, keys, rows, cols):
+    # valor de cada (linha, coluna): busca global nas chaves ou, sem elas, dentro de cada linha
+    if keys is None:
+        return search_rows(Matrix, rows, cols)
+    return lookup_ratings(keys, Matrix.data, rows.astype('int64') * Matrix.shape[1] + cols)
+
+
+def chunk_bounds(lengths, max_entries=MAX_CHUNK_ENTRIES):
+    # divide os targets em fatias cuja expansao de vizinhos cabe em max_entries
+    cum = np.cumsum(lengths)
+    total = cum[-1] if cum.shape[0] > 0 else 0
+    cuts = np.searchsorted(cum, np.arange(max_entries, total, max_entries), side='right')
+    bounds = np.unique(np.concatenate(([0], cuts, [lengths.shape[0]])))
+    return zip(bounds[:-1], bounds[1:])
+
+
+def expand_rows(Matrix, rows):
+    # (posicao do target, coluna, valor) de todas as entradas das linhas pedidas
+    starts = Matrix.indptr[rows]
+    lengths = Matrix.indptr[rows + 1] - starts
+    tgt = np.repeat(np.arange(rows.shape[0]), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.repeat(starts - offsets, lengths) + np.arange(tgt.shape[0])
+    return tgt, Matrix.indices[pos], Matrix.data[pos]
+
+
+def warm_candidates(t_user, t_mov, RatingMatrix, RatingCsc, keys, Neighbours, neighbour_keys):
+    # para cada target, percorre o menor dos dois conjuntos: os vizinhos do usuario
+    # (buscando a nota do vizinho no filme) ou quem avaliou o filme (buscando a similaridade)
+    n_neighbours = Neighbours.indptr[t_user + 1] - Neighbours.indptr[t_user]
+    n_raters = RatingCsc.indptr[t_mov + 1] - RatingCsc.indptr[t_mov]
+    by_user = np.nonzero(n_neighbours <= n_raters)[0]
+    by_mov = np.nonzero(n_neighbours > n_raters)[0]
+
+    tgt, cand_user, cand_sim = expand_rows(Neighbours, t_user[by_user])
+    tgt = by_user[tgt]
+    found, cand_rate = lookup_entries(RatingMatrix, keys, cand_user, t_mov[tgt])
+    from_user = tgt[found], cand_user[found], cand_sim[found], cand_rate[found]
+
+    tgt, cand_user, cand_rate = expand_rows(RatingCsc, t_mov[by_mov])
+    tgt = by_mov[tgt]
+    found, cand_sim = lookup_entries(Neighbours, neighbour_keys, t_user[tgt], cand_user)
+    from_mov = tgt[found], cand_user[found], cand_sim[found], cand_rate[found]
+
+    return [np.concatenate(pair) for pair in zip(from_user, from_mov)]
+
+
+def topk_weighted(tgt, cand_user, cand_sim, cand_rate, n_targets, k):
+    # media das notas dos k vizinhos mais similares de cada target, ponderada pela similaridade;
+    # mesma ordem do argsort()[-k:][::-1]: similaridade decrescente, empates pelo maior indice.
+    # Notas uint8 e similaridades float16/int8 do modelo compacto sao somadas em float32
+    cand_sim = cand_sim.astype('float32', copy=False)
+    cand_rate = cand_rate.astype('float32', copy=False)
+    order = np.lexsort((-cand_user, -cand_sim, tgt))
+    tgt, cand_sim, cand_rate = tgt[order], cand_sim[order], cand_rate[order]
+    first = np.searchsorted(tgt, np.arange(n_targets))
+    rank = np.arange(tgt.shape[0]) - first[tgt]
+    top = rank < k
+
+    topk_sim = np.zeros((n_targets, k), dtype='float32')
+    topk_prod = np.zeros((n_targets, k), dtype='float32')
+    topk_sim[tgt[top], rank[top]] = cand_sim[top]
+    topk_prod[tgt[top], rank[top]] = np.multiply(cand_sim[top], cand_rate[top])
+
+    # soma sequencial em float32, como o sum() do laco original
+    num = np.cumsum(topk_prod, axis=1)[:, -1]
+    den = np.cumsum(topk_sim, axis=1)[:, -1]
+    has_neighbours = np.bincount(tgt[top], minlength=n_targets) > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return num / den, has_neighbours
+
+
+def predict_warm(t_user, t_mov, RatingMatrix, RatingCsc, keys, Neighbours, neighbour_keys, fallback, k):
+    tgt, cand_user, cand_sim, cand_rate = warm_candidates(t_user, t_mov, RatingMatrix, RatingCsc, keys,
+                                                          Neighbours, neighbour_keys)
+    preds, has_neighbours = topk_weighted(tgt, cand_user, cand_sim, cand_rate, t_user.shape[0], k)
+    return np.where(has_neighbours, preds, fallback)
+
+
+def column_index(RatingMatrix):
+    RatingCsc = RatingMatrix.tocsc()
+    RatingCsc.sort_indices()
+    return RatingCsc
+
+
+def cold_start(users_rec, movs_rec, user_map, mov_map, tables):
+    # predicoes de reserva (media do filme para usuario frio, do usuario para filme frio,
+    # global para os dois frios); devolve tambem os indices e a mascara dos pares quentes
+    ind_user, warm_user = user_map.lookup(users_rec)
+    ind_mov, warm_mov = mov_map.lookup(movs_rec)
+    # usuario/filme que ficou sem nenhuma nota (removidas num update) conta como frio
+    warm_user &= tables.user_counts[ind_user] > 0
+    warm_mov &= tables.mov_counts[ind_mov] > 0
+
+    recomendation = np.full(users_rec.shape[0], tables.media_global, dtype='float64')
+    cold_mov = warm_user & ~warm_mov
+    cold_user = ~warm_user & warm_mov
+    recomendation[cold_mov] = tables.user_means[ind_user[cold_mov]]
+    recomendation[cold_user] = tables.mov_means[ind_mov[cold_user]]
+    return recomendation, ind_user, ind_mov, warm_user & warm_mov
+
+
+def predict_batch(users_rec, movs_rec, RatingMatrix, Neighbours, user_map, mov_map, k=DEFAULT_K,
+                  RatingCsc=None, keys=None, neighbour_keys=None, tables=None, empty_fallback='mov', search=False):
+    # RatingCsc, keys, neighbour_keys e tables podem vir prontos (e mapeados em memoria) do modelo;
+    # search=True dispensa as chaves e busca cada par dentro da linha (modelo compacto);
+    # empty_fallback diz qual media ('mov' ou 'user') serve os pares quentes sem vizinho util
+    if tables is None:
+        tables = fallback_tables(RatingMatrix)
+    recomendation, ind_user, ind_mov, warm = cold_start(users_rec, movs_rec, user_map, mov_map, tables)
+
+    # targets quentes agrupados por usuario, processados em fatias
+    warm = np.nonzero(warm)[0]
+    warm = warm[np.argsort(ind_user[warm], kind='stable')]
+    if RatingCsc is None:
+        RatingCsc = column_index(RatingMatrix)
+    if keys is None and not search:
+        keys = rating_keys(RatingMatrix)
+    if neighbour_keys is None and not search:
+        neighbour_keys = rating_keys(Neighbours)
+    lengths = np.minimum(Neighbours.indptr[ind_user[warm] + 1] - Neighbours.indptr[ind_user[warm]],
+                         RatingCsc.indptr[ind_mov[warm] + 1] - RatingCsc.indptr[ind_mov[warm]])
+    for start, end in chunk_bounds(lengths):
+        chunk = warm[start:end]
+        if empty_fallback == 'mov':
+            fallback = tables.mov_means[ind_mov[chunk]]
+        else:
+            fallback = tables.user_means[ind_user[chunk]]
+        recomendation[chunk] = predict_warm(ind_user[chunk], ind_mov[chunk], RatingMatrix, RatingCsc, keys,
+                                            Neighbours, neighbour_keys, fallback, k)
+    return recomendation
@@ -0,0 +1,109 @@
+import cProfile
+import functools
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+start_time = time.time()
+
+
+def peak_rss_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if platform.system() == "Darwin" else 1024.0)
+
+
+def current_rss_mb():
+    # RSS atual pelo /proc (Linux); None onde nao existe
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+class Profiler:
+    # mede etapas do pipeline: tempo, memoria (pico de RSS do processo e, com trace_memory,
+    # pico do tracemalloc na etapa) e quantidade de itens. Cada etapa vira uma linha JSON em
+    # 'log' ('-' para a saida padrao) e a etapa 'profile_stage' e gravada com o cProfile
+
+    def __init__(self, log=None, trace_memory=False, profile_stage=None, profile_output=None, echo=True):
+        self.records = []
+        self.echo = echo
+        self.configure(log, trace_memory, profile_stage, profile_output)
+
+    def configure(self, log=None, trace_memory=False, profile_stage=None, profile_output=None):
+        self.log = log
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.profile_output = profile_output
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, label=None, items=None):
+        # o bloco pode preencher record['items'] (ratings lidas, usuarios, targets...)
+        record = {'stage': name, 'items': items}
+        if self.echo:
+            print("%s...%.2f seconds up to now" % (label or name, time.time() - start_time))
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        profile = cProfile.Profile() if name == self.profile_stage else None
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.finish(record, time.perf_counter() - start)
+            if profile is not None:
+                profile.dump_stats(self.profile_output or "%s.prof" % name)
+
+    def timed(self, name, label=None):
+        # mesma medida como decorador; o numero de itens fica em branco
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, label):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def finish(self, record, seconds):
+        record['seconds'] = seconds
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['rss_mb'] = current_rss_mb()
+        if self.trace_memory:
+            record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+        items = record.get('items')
+        record['items_per_second'] = items / seconds if items is not None and seconds > 0 else None
+        self.records.append(record)
+        self.emit(record)
+
+    def emit(self, record):
+        if self.log is None:
+            return
+        line = json.dumps(record) + "\n"
+        if self.log == "-":
+            sys.stdout.write(line)
+            return
+        with open(self.log, "a") as f:
+            f.write(line)
+
+
+PROFILER = Profiler()
+
+
+def stage(name, label=None, items=None):
+    return PROFILER.stage(name, label, items)
+
+
+def timed(name, label=None):
+    return PROFILER.timed(name, label)
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from ratings_io import read_ratings
+from sparse_ratings import IdIndex, build_rating_matrix
+
+CACHE_VERSION = 1
+HASH_BLOCK = 16 * 1024 * 1024
+CSR_ARRAYS = ('indptr', 'indices', 'data')
+
+
+def default_cache_dir(fname):
+    return fname + ".cache"
+
+
+def file_hash(fname):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_key(fname):
+    st = os.stat(fname)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def is_fresh(meta, fname):
+    # tamanho e mtime iguais bastam; se so o mtime mudou (copia, touch), confere o hash
+    if meta.get('version') != CACHE_VERSION:
+        return False
+    key = source_key(fname)
+    if meta['size'] != key['size']:
+        return False
+    if meta['mtime_ns'] == key['mtime_ns']:
+        return True
+    return meta['sha1'] == file_hash(fname)
+
+
+def save_array(directory, name, array):
+    np.save(os.path.join(directory, name + ".npy"), np.asarray(array))
+
+
+def load_array(directory, name):
+    # .npy soltos (e nao .npz) para que np.load consiga mapear em memoria sem copiar
+    return np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+
+
+def save_csr(directory, Matrix, prefix=""):
+    for name in CSR_ARRAYS:
+        save_array(directory, prefix + name, getattr(Matrix, name))
+
+
+def load_csr(directory, shape, prefix="", fmt=sparse.csr_matrix):
+    indptr, indices, data = (load_array(directory, prefix + name) for name in CSR_ARRAYS)
+    Matrix = fmt((data, indices, indptr), shape=tuple(shape), copy=False)
+    Matrix.has_sorted_indices = True
+    return Matrix
+
+
+def save_rating_cache(cache_dir, fname, RatingMatrix, user_map, mov_map):
+    # grava o CSR e os mapas de ids como .npy soltos, lidos depois sem copia
+    os.makedirs(cache_dir, exist_ok=True)
+    save_csr(cache_dir, RatingMatrix)
+    save_array(cache_dir, 'user_ids', user_map.ids)
+    save_array(cache_dir, 'mov_ids', mov_map.ids)
+
+    meta = dict(source_key(fname), sha1=file_hash(fname), version=CACHE_VERSION,
+                shape=list(RatingMatrix.shape), source=os.path.abspath(fname))
+    write_meta(cache_dir, meta)
+
+
+def write_meta(cache_dir, meta):
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_rating_cache(cache_dir, fname):
+    # devolve (RatingMatrix, user_map, mov_map) mapeados em memoria, ou None se o cache
+    # nao existe ou nao corresponde mais ao arquivo de ratings
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if not is_fresh(meta, fname):
+        return None
+    key = source_key(fname)
+    if meta['mtime_ns'] != key['mtime_ns']:
+        # valido pelo hash: grava o mtime novo para as proximas execucoes nao lerem o arquivo de novo
+        write_meta(cache_dir, dict(meta, **key))
+
+    RatingMatrix = load_csr(cache_dir, meta['shape'])
+    return RatingMatrix, IdIndex(load_array(cache_dir, 'user_ids')), IdIndex(load_array(cache_dir, 'mov_ids'))
+
+
+def load_ratings(fname, cache_dir=None):
+    # carrega as ratings do cache quando ele esta valido; senao le o CSV, monta o CSR
+    # e (com cache_dir) grava o cache para as proximas execucoes
+    cached = load_rating_cache(cache_dir, fname) if cache_dir is not None else None
+    if cached is not None:
+        print("  cache %s carregado (%d ratings)"%(cache_dir, cached[0].nnz))
+        return cached
+
+    read_start = time.time()
+    users, movs, grades = read_ratings(fname)
+    read_time = time.time() - read_start
+    print("  %d ratings lidas em %.2fs (%.0f linhas/s)"%(users.shape[0], read_time, users.shape[0] / max(read_time, 1e-9)))
+
+    RatingMatrix, user_map, mov_map = build_rating_matrix(users, movs, grades)
+    if cache_dir is not None:
+        save_rating_cache(cache_dir, fname, RatingMatrix, user_map, mov_map)
+        print("  cache gravado em %s"%cache_dir)
+    return RatingMatrix, user_map, mov_map
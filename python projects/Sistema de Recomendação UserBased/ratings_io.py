@@ -0,0 +1,193 @@
+import numpy as np
+
+CHUNK_BYTES = 16 * 1024 * 1024
+
+
+SPACES = np.array([ord(' '), ord('\t'), ord('\r')], dtype=np.uint8)
+MAX_DIGITS = 18
+
+
+def format_error(buf, starts, ends, bad):
+    # ValueError com a primeira linha fora do formato
+    first = np.flatnonzero(bad)[0]
+    line = buf[starts[first]:ends[first]].tobytes().decode(errors='replace')
+    return ValueError("linha de ratings fora do formato uXXXXXXX:iXXXXXXX,nota: %r" % line)
+
+
+def strip_spaces(buf, starts, ends):
+    # avanca o inicio e recua o fim de cada campo sobre os espacos em volta
+    while True:
+        lead = starts < ends
+        lead[lead] = np.isin(buf[starts[lead]], SPACES)
+        if not lead.any():
+            break
+        starts = starts + lead
+    while True:
+        trail = starts < ends
+        trail[trail] = np.isin(buf[ends[trail] - 1], SPACES)
+        if not trail.any():
+            break
+        ends = ends - trail
+    return starts, ends
+
+
+def field_errors(buf, starts, ends):
+    # campos vazios, longos demais para int64 ou com algum byte fora de '0'..'9'
+    widths = ends - starts
+    cols = np.arange(max(int(widths.max()), 1))
+    valid = cols[None, :] < widths[:, None]
+    pos = np.where(valid, starts[:, None] + cols[None, :], 0)
+    digits = (buf[pos] >= ord('0')) & (buf[pos] <= ord('9'))
+    return (widths < 1) | (widths > MAX_DIGITS) | (valid & ~digits).any(axis=1)
+
+
+def parse_fields(buf, starts, ends):
+    # converte os campos numericos buf[starts:ends] (ja validados) em inteiros, sem passar por str
+    widths = ends - starts
+    if starts.shape[0] == 0:
+        return np.zeros(0, dtype='int64')
+    cols = np.arange(widths.max())
+    valid = cols[None, :] < widths[:, None]
+    pos = np.where(valid, starts[:, None] + cols[None, :], 0)
+    digits = np.where(valid, buf[pos].astype('int64') - 48, 0)
+    powers = np.where(valid, widths[:, None] - 1 - cols[None, :], 0)
+    return (digits * 10 ** powers).sum(axis=1)
+
+
+def line_separators(buf, line_ends, char):
+    # posicao do separador de cada linha e as linhas sem exatamente um
+    found = np.flatnonzero(buf == ord(char))
+    counts = np.bincount(np.searchsorted(line_ends, found), minlength=line_ends.shape[0])
+    bad = counts[:line_ends.shape[0]] != 1
+    if bad.any():
+        return None, bad
+    return found, bad
+
+
+def parse_chunk(buf, has_grades=True):
+    # linhas no formato uXXXXXXX:iXXXXXXX[,nota], cada uma terminada por '\n'; espacos em volta da
+    # linha e da nota sao ignorados e qualquer outro desvio levanta ValueError
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts, line_ends = strip_spaces(buf, np.concatenate(([0], ends[:-1] + 1)), ends)
+    keep = line_ends > starts
+    starts, line_ends = starts[keep], line_ends[keep]
+    if starts.shape[0] == 0:
+        empty = np.zeros(0, dtype='int64')
+        return empty, empty, empty if has_grades else None
+
+    colons, bad = line_separators(buf, line_ends, ':')
+    if colons is None:
+        raise format_error(buf, starts, line_ends, bad)
+    if has_grades:
+        commas, bad = line_separators(buf, line_ends, ',')
+        if commas is None:
+            raise format_error(buf, starts, line_ends, bad)
+        mov_ends = commas
+    else:
+        mov_ends = line_ends
+
+    bad = (buf[starts] != ord('u')) | (buf[colons + 1] != ord('i')) | (mov_ends <= colons)
+    bad |= field_errors(buf, starts + 1, colons) | field_errors(buf, colons + 2, mov_ends)
+    if has_grades:
+        grade_starts, grade_ends = strip_spaces(buf, commas + 1, line_ends)
+        bad |= field_errors(buf, grade_starts, grade_ends)
+    if bad.any():
+        raise format_error(buf, starts, line_ends, bad)
+
+    users = parse_fields(buf, starts + 1, colons)
+    movs = parse_fields(buf, colons + 2, mov_ends)
+    if not has_grades:
+        return users, movs, None
+    return users, movs, parse_fields(buf, grade_starts, grade_ends)
+
+
+def iter_chunks(fname, chunk_bytes=CHUNK_BYTES):
+    # blocos do arquivo cortados no ultimo '\n', sem a linha de cabecalho
+    with open(fname, "rb") as f:
+        header = f.readline()
+        rest = header if header.startswith(b"u") else b""
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            if cut == 0:
+                rest = data
+                continue
+            rest = data[cut:]
+            yield np.frombuffer(data[:cut], dtype=np.uint8)
+        if rest.strip():
+            yield np.frombuffer(rest + b"\n", dtype=np.uint8)
+
+
+def read_ratings(fname, chunk_bytes=CHUNK_BYTES):
+    # leitura em uma passada, bloco a bloco, direto para int32/int32/int16
+    users, movs, grades = [], [], []
+    for buf in iter_chunks(fname, chunk_bytes):
+        u, m, g = parse_chunk(buf)
+        users.append(u.astype('int32'))
+        movs.append(m.astype('int32'))
+        grades.append(g.astype('int16'))
+    if len(users) == 0:
+        return np.zeros(0, dtype='int32'), np.zeros(0, dtype='int32'), np.zeros(0, dtype='int16')
+    return np.concatenate(users), np.concatenate(movs), np.concatenate(grades)
+
+
+def iter_targets(fname, chunk_bytes=CHUNK_BYTES):
+    # pares uXXXXXXX:iXXXXXXX a prever, bloco a bloco: linhas originais (para a saida) e ids
+    for buf in iter_chunks(fname, chunk_bytes):
+        users, movs, _ = parse_chunk(buf, has_grades=False)
+        yield buf.tobytes().split(), users, movs
+
+
+def read_targets(fname, chunk_bytes=CHUNK_BYTES):
+    names, users, movs = [], [], []
+    for lines, u, m in iter_targets(fname, chunk_bytes):
+        names.extend(line.decode() for line in lines)
+        users.append(u)
+        movs.append(m)
+    if len(users) == 0:
+        return [], np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+    return names, np.concatenate(users), np.concatenate(movs)
+
+
+class PredictionWriter:
+    # grava o saida.csv a medida que os blocos de predicoes ficam prontos, no mesmo
+    # formato UserId:ItemId,Prediction com 4 casas
+
+    def __init__(self, fname):
+        self.f = open(fname, "wb")
+        self.f.write(b"UserId:ItemId,Prediction\n")
+
+    def write(self, lines, recs):
+        self.f.write(b"".join(b"%s,%.4f\n" % pair for pair in zip(lines, recs.tolist())))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_user_ids(fname):
+    # um id de usuario (uXXXXXXX) por linha; cabecalho opcional
+    users = []
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line[:1] == "u" and line[1:].isdigit():
+                users.append(int(line[1:]))
+    return np.asarray(users, dtype='int64')
+
+
+def write_recommendations(fname, user_ids, results):
+    # uma linha UserId:ItemId,Prediction por recomendacao, na ordem do ranking de cada usuario
+    with open(fname, "w") as f:
+        f.write("UserId:ItemId,Prediction\n")
+        for user, (items, scores) in zip(user_ids, results):
+            for item, score in zip(items, scores):
+                f.write("u%07d:i%07d,%.4f\n" % (user, item, score))
@@ -0,0 +1,124 @@
+import numpy as np
+
+from prediction import DEFAULT_K, expand_rows, topk_weighted
+
+DEFAULT_TOP_N = 20
+DEFAULT_SUPPORT_SHRINKAGE = 5.0
+USERS_PER_CHUNK = 256
+
+
+def popular_items(model):
+    # filmes por numero de ratings: reserva para usuarios frios ou com poucos candidatos
+    if not hasattr(model, 'popular'):
+        model.popular = np.argsort(-np.asarray(model.tables.mov_counts), kind='stable')
+    return model.popular
+
+
+def shrink_scores(model, ind_user, tgt, scores, support, shrinkage):
+    # nota encolhida para a media do usuario pelo suporte s (vizinhos, ou filmes avaliados, que
+    # levam ao candidato): (s * nota + shrinkage * media) / (s + shrinkage). Sem isso um filme
+    # visto por um unico vizinho fica com a nota crua dele e um 10 isolado domina o top-N
+    if shrinkage <= 0:
+        return scores
+    means = np.asarray(model.tables.user_means, dtype='float64')[ind_user[tgt]]
+    return (support * scores + shrinkage * means) / (support + shrinkage)
+
+
+def candidate_scores(model, ind_user, k=DEFAULT_K, min_support=1, shrinkage=DEFAULT_SUPPORT_SHRINKAGE):
+    # gera os candidatos e calcula a nota de cada um com a mesma conta do predict, encolhida
+    # pelo suporte (shrink_scores).
+    # user-based: filmes avaliados pelos vizinhos do usuario; cada vizinho ja traz nota e
+    # similaridade, entao a nota sai direto da expansao.
+    # item-based: vizinhos dos filmes que o usuario avaliou; como a lista podada do filme
+    # candidato nao e a transposta das listas dos filmes avaliados, a nota vem do predict
+    num_movs = model.RatingMatrix.shape[1]
+    if model.mode == 'mf':
+        return factor_candidates(model, ind_user)
+    if model.mode == 'user':
+        tgt, nb, sims = expand_rows(model.Neighbours, ind_user)
+        pos, items, rates = expand_rows(model.RatingMatrix, nb)
+        tgt, source, sims = tgt[pos], nb[pos], sims[pos]
+    else:
+        tgt, source, rates = expand_rows(model.RatingMatrix, ind_user)
+        pos, items, sims = expand_rows(model.Neighbours, source)
+        tgt, source, rates = tgt[pos], source[pos], rates[pos]
+
+    # candidatos ja avaliados pelo usuario ficam de fora
+    seen_tgt, seen_items, _ = expand_rows(model.RatingMatrix, ind_user)
+    seen = seen_tgt.astype('int64') * num_movs + seen_items
+    pair = tgt.astype('int64') * num_movs + items
+    keep = ~np.isin(pair, seen)
+    pair, source, sims, rates = pair[keep], source[keep], sims[keep], rates[keep]
+
+    pairs, group, support = np.unique(pair, return_inverse=True, return_counts=True)
+    if model.mode == 'user':
+        scores, has_neighbours = topk_weighted(group, source, sims, rates, pairs.shape[0], k)
+        keep = has_neighbours & (support >= min_support)
+        tgt, items = pairs[keep] // num_movs, pairs[keep] % num_movs
+        scores = scores[keep].astype('float64')
+        return tgt, items, shrink_scores(model, ind_user, tgt, scores, support[keep], shrinkage)
+
+    keep = support >= min_support
+    tgt, items = pairs[keep] // num_movs, pairs[keep] % num_movs
+    scores = model.predict(model.user_map.ids[ind_user[tgt]], model.mov_map.ids[items], k=k)
+    return tgt, items, shrink_scores(model, ind_user, tgt, scores, support[keep], shrinkage)
+
+
+def factor_candidates(model, ind_user):
+    # fatoracao: todo filme ainda nao avaliado e candidato, com a nota do produto dos fatores
+    num_movs = model.RatingMatrix.shape[1]
+    tgt = np.repeat(np.arange(ind_user.shape[0]), num_movs)
+    items = np.tile(np.arange(num_movs), ind_user.shape[0])
+    seen_tgt, seen_items, _ = expand_rows(model.RatingMatrix, ind_user)
+    keep = ~np.isin(tgt.astype('int64') * num_movs + items, seen_tgt.astype('int64') * num_movs + seen_items)
+    tgt, items = tgt[keep], items[keep]
+    return tgt, items, model.score(ind_user[tgt], items)
+
+
+def recommend_batch(model, user_ids, n=DEFAULT_TOP_N, k=DEFAULT_K, min_support=1,
+                    shrinkage=DEFAULT_SUPPORT_SHRINKAGE):
+    # top-n filmes (ids, notas previstas) de cada usuario; completa com os filmes mais
+    # populares ainda nao avaliados quando faltam candidatos (ou o usuario e frio)
+    user_ids = np.asarray(user_ids)
+    ind_user, warm = model.user_map.lookup(user_ids)
+    warm &= np.asarray(model.tables.user_counts)[ind_user] > 0
+    results = [(np.zeros(0, dtype='int64'), np.zeros(0))] * user_ids.shape[0]
+    warm_pos = np.flatnonzero(warm)
+
+    for start in range(0, warm_pos.shape[0], USERS_PER_CHUNK):
+        chunk = warm_pos[start:start + USERS_PER_CHUNK]
+        tgt, items, scores = candidate_scores(model, ind_user[chunk], k=k, min_support=min_support,
+                                              shrinkage=shrinkage)
+        order = np.lexsort((items, -scores, tgt))
+        tgt, items, scores = tgt[order], items[order], scores[order]
+        first = np.searchsorted(tgt, np.arange(chunk.shape[0] + 1))
+        for i, pos in enumerate(chunk):
+            top = slice(first[i], min(first[i] + n, first[i + 1]))
+            results[pos] = (items[top], scores[top])
+
+    for pos in range(user_ids.shape[0]):
+        items, scores = results[pos]
+        if items.shape[0] < n:
+            items, scores = fill_popular(model, ind_user[pos] if warm[pos] else -1, items, scores, n)
+        results[pos] = (model.mov_map.ids[items], scores)
+    return results
+
+
+def fill_popular(model, ind_user, items, scores, n):
+    exclude = set(items.tolist())
+    if ind_user >= 0:
+        start, end = model.RatingMatrix.indptr[ind_user], model.RatingMatrix.indptr[ind_user + 1]
+        exclude.update(model.RatingMatrix.indices[start:end].tolist())
+    extra = []
+    for item in popular_items(model):
+        if len(extra) + items.shape[0] >= n:
+            break
+        if item not in exclude:
+            extra.append(item)
+    extra = np.asarray(extra, dtype='int64')
+    extra_scores = np.asarray(model.tables.mov_means, dtype='float64')[extra]
+    return np.concatenate((items, extra)).astype('int64'), np.concatenate((scores, extra_scores))
+
+
+def recommend(model, user_id, n=DEFAULT_TOP_N, k=DEFAULT_K, min_support=1, shrinkage=DEFAULT_SUPPORT_SHRINKAGE):
+    return recommend_batch(model, [user_id], n=n, k=k, min_support=min_support, shrinkage=shrinkage)[0]
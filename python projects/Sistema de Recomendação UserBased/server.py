@@ -0,0 +1,223 @@
+import json
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from cache import DEFAULT_NEIGHBOURHOOD_CACHE, DEFAULT_PREDICTION_CACHE, CachedModel
+from prediction import DEFAULT_K
+from recommend import DEFAULT_TOP_N
+
+DEFAULT_PORT = 8080
+DEFAULT_BATCH_WINDOW_MS = 2.0
+DEFAULT_MAX_BATCH = 8192
+LATENCY_WINDOW = 10000
+
+
+TARGET_PATTERN = re.compile(r"u(\d{1,9}):i(\d{1,9})")
+USER_PATTERN = re.compile(r"u(\d{1,9})")
+
+
+def parse_target(target):
+    # "u0000039:i0060196" -> (39, 60196); ids com ate 9 digitos, para caberem no int64 da predicao
+    match = TARGET_PATTERN.fullmatch(target)
+    if match is None:
+        raise ValueError("target fora do formato uXXXXXXX:iXXXXXXX: %r" % target)
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_user(user):
+    match = USER_PATTERN.fullmatch(user)
+    if match is None:
+        raise ValueError("usuario fora do formato uXXXXXXX: %r" % user)
+    return int(match.group(1))
+
+
+class LatencyStats:
+    # ultimas latencias de cada rota, para os percentis do /stats
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.counts = {}
+        self.batches = 0
+        self.batched_pairs = 0
+
+    def record(self, route, seconds):
+        with self.lock:
+            self.latencies.setdefault(route, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def record_batch(self, pairs):
+        with self.lock:
+            self.batches += 1
+            self.batched_pairs += pairs
+
+    def summary(self):
+        with self.lock:
+            routes = {}
+            for route, values in self.latencies.items():
+                ms = np.asarray(values) * 1000.0
+                routes[route] = {'requests': self.counts[route],
+                                 'p50_ms': float(np.percentile(ms, 50)),
+                                 'p90_ms': float(np.percentile(ms, 90)),
+                                 'p99_ms': float(np.percentile(ms, 99)),
+                                 'max_ms': float(ms.max())}
+            return {'routes': routes, 'batches': self.batches,
+                    'mean_batch_pairs': self.batched_pairs / self.batches if self.batches else 0.0}
+
+
+class PredictBatcher:
+    # junta os pares de varias requisicoes /predict que chegam dentro de uma janela curta
+    # e faz uma unica chamada vetorizada ao modelo
+
+    def __init__(self, model, stats, k=DEFAULT_K, window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH):
+        self.model = model
+        self.stats = stats
+        self.k = k
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, users, movs):
+        future = Future()
+        self.queue.put((users, movs, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = batch[0][0].shape[0]
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += batch[-1][0].shape[0]
+
+            try:
+                preds = self.model.predict(np.concatenate([b[0] for b in batch]),
+                                           np.concatenate([b[1] for b in batch]), k=self.k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats.record_batch(size)
+            start = 0
+            for users, _, future in batch:
+                future.set_result(preds[start:start + users.shape[0]])
+                start += users.shape[0]
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    # GET /recommend?user=u0000039&n=20, POST /predict {"targets": ["u0000039:i0060196", ...]},
+    # GET /stats, GET /health
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def timed(self, route, handler):
+        start = time.perf_counter()
+        try:
+            status, payload = handler()
+        except KeyError as e:
+            status, payload = 400, {'error': "campo ausente: %s" % e.args[0]}
+        except (ValueError, IndexError) as e:
+            status, payload = 400, {'error': str(e)}
+        self.send_json(status, payload)
+        self.service.stats.record(route, time.perf_counter() - start)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/recommend":
+            self.timed("/recommend", lambda: self.service.recommend(parse_qs(url.query)))
+        elif url.path == "/stats":
+            self.send_json(200, self.service.summary())
+        elif url.path == "/health":
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'rota desconhecida'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self.send_json(404, {'error': 'rota desconhecida'})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.timed("/predict", lambda: self.service.predict(json.loads(body)))
+
+
+class ScoringServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+
+class ScoringService:
+    # modelo carregado uma vez e mantido em memoria enquanto o servidor estiver no ar
+
+    def __init__(self, model, k=DEFAULT_K, window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH,
+                 prediction_cache=DEFAULT_PREDICTION_CACHE, neighbourhood_cache=DEFAULT_NEIGHBOURHOOD_CACHE):
+        self.model = CachedModel(model, prediction_cache=prediction_cache, neighbourhood_cache=neighbourhood_cache)
+        self.k = k
+        self.stats = LatencyStats()
+        self.batcher = PredictBatcher(self.model, self.stats, k=k, window_ms=window_ms, max_batch=max_batch)
+
+    def summary(self):
+        return dict(self.stats.summary(), cache=self.model.cache_stats())
+
+    def predict(self, payload):
+        # corpo JSON valido mas de outro formato tambem e erro do cliente (400)
+        if not isinstance(payload, dict):
+            raise ValueError("o corpo deve ser um objeto JSON com o campo 'targets'")
+        targets = payload['targets']
+        if not isinstance(targets, list) or not all(isinstance(t, str) for t in targets):
+            raise ValueError("'targets' deve ser uma lista de pares 'uXXXXXXX:iXXXXXXX'")
+        pairs = np.asarray([parse_target(t) for t in targets], dtype='int64').reshape(-1, 2)
+        preds = self.batcher.submit(pairs[:, 0], pairs[:, 1]).result()
+        return 200, {'predictions': [round(float(p), 4) for p in preds]}
+
+    def recommend(self, query):
+        user = query['user'][0]
+        n = int(query.get('n', [DEFAULT_TOP_N])[0])
+        if n < 1:
+            raise ValueError("n deve ser pelo menos 1")
+        items, scores = self.model.recommend(parse_user(user), n=n, k=self.k)
+        return 200, {'user': user, 'items': [{'item': "i%07d" % item, 'score': round(float(score), 4)}
+                                             for item, score in zip(items, scores)]}
+
+
+def serve(model, host="127.0.0.1", port=DEFAULT_PORT, k=DEFAULT_K,
+          window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH,
+          prediction_cache=DEFAULT_PREDICTION_CACHE, neighbourhood_cache=DEFAULT_NEIGHBOURHOOD_CACHE):
+    ScoringHandler.service = ScoringService(model, k=k, window_ms=window_ms, max_batch=max_batch,
+                                            prediction_cache=prediction_cache,
+                                            neighbourhood_cache=neighbourhood_cache)
+    httpd = ScoringServer((host, port), ScoringHandler)
+    print("  servindo em http://%s:%d (/predict, /recommend, /stats)" % (host, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
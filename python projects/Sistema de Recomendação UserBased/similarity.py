@@ -0,0 +1,197 @@
+import numpy as np
+from scipy import sparse
+
+from sparse_ratings import normalize_rows, rating_indicator, row_norms
+
+DEFAULT_BLOCK_SIZE = 1024
+DEFAULT_NEIGHBOURS = 250
+SIMILARITIES = ('cosine', 'pearson', 'adjusted')
+SIM_DTYPES = ('float16', 'int8')
+INT8_SCALE = 127
+
+
+class SimilarityFilter:
+    # filtros aplicados em cada bloco enquanto as similaridades sao calculadas, antes do top-N:
+    # minimo de notas em comum (min_common), encolhimento n / (n + shrinkage) pelo numero n de
+    # notas em comum, similaridade minima depois do encolhimento e, nas similaridades
+    # centralizadas (pearson/adjusted), so correlacoes positivas
+
+    def __init__(self, min_common=1, shrinkage=0.0, min_similarity=None, positive_only=False):
+        self.min_common = min_common
+        self.shrinkage = shrinkage
+        self.min_similarity = min_similarity
+        self.positive_only = positive_only
+        # so entao e preciso contar as notas em comum (um produto esparso a mais por bloco,
+        # do mesmo tamanho do das similaridades)
+        self.uses_common = min_common > 1 or shrinkage > 0
+        self.block_products = 2 if self.uses_common else 1
+
+    def weights(self, common):
+        common = np.asarray(common, dtype='float32')
+        weights = common / (common + np.float32(self.shrinkage))
+        weights[common < self.min_common] = 0
+        return weights
+
+    def threshold(self, sims):
+        if self.positive_only:
+            sims[sims < 0] = 0
+        if self.min_similarity is not None:
+            sims[sims < self.min_similarity] = 0
+        return sims
+
+    def apply(self, SimBlock, Common=None):
+        # Common: contagens de notas em comum do mesmo bloco (necessarias com uses_common)
+        if self.uses_common:
+            Common.data = self.weights(Common.data)
+            SimBlock = SimBlock.multiply(Common).tocsr()
+        self.threshold(SimBlock.data)
+        SimBlock.eliminate_zeros()
+        return SimBlock
+
+
+def block_size_for_budget(num_users, memory_mb, products=1):
+    # pior caso de um bloco: cada linha com similaridade para todos os usuarios
+    # (indice int32 + valor float32 = 8 bytes por entrada), vezes os produtos do mesmo
+    # tamanho feitos por bloco (2 com a contagem de notas em comum dos filtros)
+    return max(1, int(memory_mb * 1024 * 1024) // (num_users * 8 * products))
+
+
+def iter_similarity_blocks(RatingMatrix, block_size=DEFAULT_BLOCK_SIZE, norms=None, rows=None, filters=None,
+                           n_neighbours=None):
+    # linhas de D @ D.T em blocos, ja passadas pelos filtros; rows restringe o calculo a
+    # alguns usuarios (os blocos entao correspondem a rows[start:end]). Com n_neighbours cada
+    # bloco e podado ao top-N antes de ordenar as colunas, entao so o que fica e ordenado
+    if norms is None:
+        norms = row_norms(RatingMatrix)
+    if filters is None:
+        filters = SimilarityFilter()
+    D = normalize_rows(RatingMatrix, norms)
+    # transpostas em CSR uma vez: com CSC o produto esparso converteria a transposta inteira
+    # de novo em cada bloco
+    DT = D.T.tocsr()
+    if filters.uses_common:
+        Ind = rating_indicator(D)
+        IndT = Ind.T.tocsr()
+    num_rows = D.shape[0] if rows is None else rows.shape[0]
+    for start in range(0, num_rows, block_size):
+        end = min(start + block_size, num_rows)
+        block = slice(start, end) if rows is None else rows[start:end]
+        SimBlock = (D[block] @ DT).tocsr()
+        Common = (Ind[block] @ IndT).tocsr() if filters.uses_common else None
+        SimBlock = keep_top_n(filters.apply(SimBlock, Common), n_neighbours)
+        SimBlock.sort_indices()
+        yield start, end, SimBlock
+
+
+def keep_top_n(SimBlock, n_neighbours):
+    # mantem em cada linha apenas os n vizinhos mais similares, na ordem das colunas da
+    # entrada; empates no n-esimo valor ficam com os menores indices de usuario, entao o
+    # resultado nao depende da ordem das colunas (o bloco pode ser podado antes de ordenado)
+    counts = np.diff(SimBlock.indptr)
+    if n_neighbours is None or n_neighbours <= 0 or counts.max(initial=0) <= n_neighbours:
+        return SimBlock
+
+    keep = np.zeros(SimBlock.data.shape[0], dtype=bool)
+    keep[np.repeat(counts <= n_neighbours, counts)] = True
+    for row in np.nonzero(counts > n_neighbours)[0]:
+        start, end = SimBlock.indptr[row], SimBlock.indptr[row + 1]
+        data = SimBlock.data[start:end]
+        cutoff = -np.partition(-data, n_neighbours - 1)[n_neighbours - 1]
+        above = data > cutoff
+        ties = np.flatnonzero(data == cutoff)
+        ties = ties[np.argsort(SimBlock.indices[start + ties], kind='stable')[:n_neighbours - above.sum()]]
+        keep[start + np.flatnonzero(above)] = True
+        keep[start + ties] = True
+
+    indptr = np.zeros(SimBlock.shape[0] + 1, dtype=SimBlock.indptr.dtype)
+    np.cumsum(np.minimum(counts, n_neighbours), out=indptr[1:])
+    return sparse.csr_matrix((SimBlock.data[keep], SimBlock.indices[keep], indptr), shape=SimBlock.shape)
+
+
+def quantize_similarities(SimMatrix, sim_dtype=None):
+    # similaridades em float16 ou int8 (valor * 127). A predicao e uma media ponderada pelas
+    # similaridades, entao a escala comum do int8 se cancela e nao precisa ser desfeita.
+    # No int8 as similaridades pequenas ficam com modulo 1 em vez de 0, para o conjunto de
+    # vizinhos nao mudar; o que ainda virar 0 (underflow do float16) sai da lista
+    if sim_dtype is None:
+        return SimMatrix
+    if sim_dtype == 'int8':
+        scaled = np.clip(np.round(SimMatrix.data * INT8_SCALE), -INT8_SCALE, INT8_SCALE)
+        data = (np.sign(SimMatrix.data) * np.maximum(np.abs(scaled), 1)).astype('int8')
+    else:
+        data = SimMatrix.data.astype(sim_dtype)
+    # zeros tirados a mao: as rotinas do scipy.sparse nao aceitam float16
+    keep = data != 0
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    Quantized = sparse.csr_matrix((data[keep], SimMatrix.indices[keep], kept[SimMatrix.indptr]), shape=SimMatrix.shape)
+    Quantized.has_sorted_indices = SimMatrix.has_sorted_indices
+    return Quantized
+
+
+def dequantize_similarities(SimMatrix):
+    # volta para float32 (e para a escala do cosseno no caso do int8)
+    data = SimMatrix.data.astype('float32')
+    if SimMatrix.dtype == np.int8:
+        data /= INT8_SCALE
+    return sparse.csr_matrix((data, SimMatrix.indices, SimMatrix.indptr), shape=SimMatrix.shape)
+
+
+def resolve_block_size(num_users, block_size=None, memory_mb=None, products=1):
+    if block_size is not None:
+        return block_size
+    if memory_mb is not None:
+        return block_size_for_budget(num_users, memory_mb, products)
+    return DEFAULT_BLOCK_SIZE
+
+
+def blocked_cosine_similarity(RatingMatrix, block_size=None, memory_mb=None, n_neighbours=None, norms=None,
+                              filters=None, sim_dtype=None):
+    # calcula D @ D.T em blocos de linhas, guardando apenas as similaridades nao nulas
+    # (ou, com n_neighbours, apenas os n vizinhos mais similares de cada usuario);
+    # com sim_dtype cada bloco ja e guardado compactado
+    block_size = resolve_block_size(RatingMatrix.shape[0], block_size, memory_mb,
+                                    filters.block_products if filters is not None else 1)
+    blocks = [quantize_similarities(SimBlock, sim_dtype)
+              for _, _, SimBlock in iter_similarity_blocks(RatingMatrix, block_size, norms=norms, filters=filters,
+                                                           n_neighbours=n_neighbours)]
+    if len(blocks) == 0:
+        return sparse.csr_matrix((0, 0), dtype='float32')
+    SimMatrix = sparse.vstack(blocks, format='csr')
+    SimMatrix.sort_indices()
+    return SimMatrix
+
+
+def update_neighbours(Neighbours, RatingMatrix, norms, affected, n_neighbours, block_size=None, memory_mb=None,
+                      filters=None):
+    # recalcula as linhas dos usuarios afetados e, pela simetria do cosseno, as colunas
+    # deles nas listas dos demais usuarios; o resto do indice e reaproveitado.
+    # Aproximacao: se um afetado sai do top-N de v, o substituto de v so aparece num fit completo.
+    num_users = RatingMatrix.shape[0]
+    is_affected = np.zeros(num_users, dtype=bool)
+    is_affected[affected] = True
+
+    Old = Neighbours.tocoo()
+    keep = ~is_affected[Old.row] & ~is_affected[Old.col]
+    rows, cols, data = [Old.row[keep]], [Old.col[keep]], [Old.data[keep]]
+
+    block_size = resolve_block_size(num_users, block_size, memory_mb,
+                                    filters.block_products if filters is not None else 1)
+    for start, end, SimBlock in iter_similarity_blocks(RatingMatrix, block_size, norms=norms, rows=affected,
+                                                       filters=filters):
+        Block = SimBlock.tocoo()
+        block_rows = affected[start:end][Block.row]
+        rows.append(block_rows)
+        cols.append(Block.col)
+        data.append(Block.data)
+        # mesma similaridade na linha do outro usuario (se ele nao for afetado)
+        other = ~is_affected[Block.col]
+        rows.append(Block.col[other])
+        cols.append(block_rows[other])
+        data.append(Block.data[other])
+
+    Updated = sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(num_users, num_users), dtype='float32')
+    Updated.sort_indices()
+    Updated = keep_top_n(Updated, n_neighbours)
+    Updated.sort_indices()
+    return Updated
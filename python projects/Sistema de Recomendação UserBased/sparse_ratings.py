@@ -0,0 +1,136 @@
+import numpy as np
+from scipy import sparse
+
+
+class IdIndex:
+    # mapeamento id -> indice de linha/coluna: ids ordenados + busca binaria,
+    # montado uma vez na leitura e reaproveitado na predicao
+
+    def __init__(self, ids):
+        self.ids = np.asarray(ids)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def lookup(self, query):
+        # indices e mascara de ids conhecidos (False = usuario/filme frio)
+        query = np.asarray(query)
+        if self.ids.shape[0] == 0:
+            return np.zeros(query.shape, dtype='int64'), np.zeros(query.shape, dtype=bool)
+        pos = np.searchsorted(self.ids, query)
+        pos[pos == self.ids.shape[0]] = 0
+        return pos, self.ids[pos] == query
+
+    def get(self, id_, default=-1):
+        pos = int(np.searchsorted(self.ids, id_))
+        if pos < self.ids.shape[0] and self.ids[pos] == id_:
+            return pos
+        return default
+
+    def __contains__(self, id_):
+        return self.get(id_) >= 0
+
+
+def build_rating_matrix(users, movies, grades):
+    # codifica os ids em indices inteiros (ordenados, como as linhas/colunas do pivot)
+    index, user_idx = np.unique(users, return_inverse=True)
+    movies_ids, mov_idx = np.unique(movies, return_inverse=True)
+
+    # par usuario/filme repetido: fica a ultima nota do arquivo, como no update e no evaluate
+    # (o CSR montado de triplas somaria as notas repetidas)
+    keys = user_idx.astype('int64') * movies_ids.shape[0] + mov_idx
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = keys.shape[0] - 1 - last
+    RatingMatrix = sparse.csr_matrix(
+        (np.asarray(grades, dtype='float32')[last], (user_idx[last].astype('int32'), mov_idx[last].astype('int32'))),
+        shape=(index.shape[0], movies_ids.shape[0]), dtype='float32')
+    RatingMatrix.eliminate_zeros()
+    RatingMatrix.sort_indices()
+    return RatingMatrix, IdIndex(index), IdIndex(movies_ids)
+
+
+def compact_grade_values(grades):
+    # notas inteiras de 0 a 255 cabem em uint8: 1 byte por rating em vez de 4
+    grades = np.asarray(grades)
+    if grades.shape[0] and (grades.min() < 0 or grades.max() > 255 or np.any(grades != np.round(grades))):
+        raise ValueError("o armazenamento compacto exige notas inteiras entre 0 e 255")
+    return grades.astype('uint8')
+
+
+def compact_grades(RatingMatrix):
+    return sparse.csr_matrix((compact_grade_values(RatingMatrix.data), RatingMatrix.indices, RatingMatrix.indptr),
+                             shape=RatingMatrix.shape)
+
+
+def row_norms(RatingMatrix):
+    if RatingMatrix.dtype != np.float32:
+        # o quadrado de uma nota uint8 estoura o tipo
+        RatingMatrix = RatingMatrix.astype('float32')
+    return np.sqrt(np.asarray(RatingMatrix.multiply(RatingMatrix).sum(axis=1)).ravel()).astype('float32')
+
+
+def rating_indicator(RatingMatrix):
+    # 1 em cada nota existente: Ind @ Ind.T conta as notas em comum de cada par de linhas
+    return sparse.csr_matrix((np.ones(RatingMatrix.indices.shape[0], dtype='float32'), RatingMatrix.indices,
+                              RatingMatrix.indptr), shape=RatingMatrix.shape)
+
+
+def normalize_rows(RatingMatrix, norms):
+    # divide cada nota pela norma da linha (linhas sem notas ficam zeradas)
+    rows = np.repeat(np.arange(RatingMatrix.shape[0]), np.diff(RatingMatrix.indptr))
+    D = RatingMatrix.copy()
+    D.data = np.nan_to_num(D.data / norms[rows], copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    return D
+
+
+def center_rows(RatingMatrix):
+    # subtrai a media de cada linha so das notas existentes: a esparsidade nao muda e as
+    # entradas nao avaliadas continuam valendo 0 (linhas sem notas ficam como estao)
+    counts = np.diff(RatingMatrix.indptr)
+    means = np.asarray(RatingMatrix.sum(axis=1)).ravel() / np.maximum(counts, 1)
+    Centered = RatingMatrix.copy()
+    Centered.data = (Centered.data - np.repeat(means, counts)).astype('float32')
+    return Centered
+
+
+def center_columns(RatingMatrix):
+    # mesma centralizacao pela media de cada coluna
+    counts = np.bincount(RatingMatrix.indices, minlength=RatingMatrix.shape[1])
+    means = np.asarray(RatingMatrix.sum(axis=0)).ravel() / np.maximum(counts, 1)
+    Centered = RatingMatrix.copy()
+    Centered.data = (Centered.data - means[Centered.indices]).astype('float32')
+    return Centered
+
+
+def last_rating_per_pair(users, movs, grades):
+    # remove pares repetidos de um lote, ficando com a ultima nota de cada um
+    users, movs, grades = np.asarray(users)[::-1], np.asarray(movs)[::-1], np.asarray(grades)[::-1]
+    _, first = np.unique(np.stack((users.astype('int64'), movs.astype('int64'))), axis=1, return_index=True)
+    return users[first], movs[first], grades[first]
+
+
+def merge_ratings(RatingMatrix, user_map, mov_map, users, movs, grades):
+    # junta um lote novo de ratings ao CSR (a nota nova substitui a antiga do mesmo par;
+    # nota 0 remove o par). Devolve tambem a posicao nova de cada usuario antigo e os
+    # indices (novos) dos usuarios que receberam ratings
+    new_user_map = IdIndex(np.union1d(user_map.ids, users))
+    new_mov_map = IdIndex(np.union1d(mov_map.ids, movs))
+    user_pos = new_user_map.lookup(user_map.ids)[0]
+    mov_pos = new_mov_map.lookup(mov_map.ids)[0]
+
+    Old = RatingMatrix.tocoo()
+    num_movs = len(new_mov_map)
+    old_keys = user_pos[Old.row].astype('int64') * num_movs + mov_pos[Old.col]
+    delta_users = new_user_map.lookup(users)[0]
+    delta_keys = delta_users.astype('int64') * num_movs + new_mov_map.lookup(movs)[0]
+
+    # delta invertido antes dos antigos: np.unique fica com a ultima nota do delta
+    keys = np.concatenate((delta_keys[::-1], old_keys))
+    values = np.concatenate((np.asarray(grades, dtype='float32')[::-1], Old.data))
+    keys, first = np.unique(keys, return_index=True)
+
+    Merged = sparse.csr_matrix((values[first], (keys // num_movs, keys % num_movs)),
+                               shape=(len(new_user_map), num_movs), dtype='float32')
+    Merged.eliminate_zeros()
+    Merged.sort_indices()
+    return Merged, new_user_map, new_mov_map, user_pos, np.unique(delta_users)
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from model import fit
+from prediction import DEFAULT_K
+from ratings_io import read_ratings, read_targets
+from sparse_ratings import build_rating_matrix
+
+RATINGS = os.path.join(HERE, "fixtures", "ratings.csv")
+TARGETS = os.path.join(HERE, "fixtures", "targets.csv")
+
+
+def baseline_predictions(ratings, targets, k=DEFAULT_K):
+    # laco da versao original (matriz densa, SimMatrix inteira e um target por vez),
+    # com o pivot do pandas trocado por np.unique
+    lines = [line.strip() for line in open(ratings)][1:]
+    pairs = [line.split(",")[0].split(":") for line in lines]
+    users = np.asarray([int(u[1:]) for u, _ in pairs])
+    movs = np.asarray([int(m[1:]) for _, m in pairs])
+    grades = np.asarray([int(line.split(",")[1]) for line in lines], dtype='int16')
+    index, user_idx = np.unique(users, return_inverse=True)
+    movies, mov_idx = np.unique(movs, return_inverse=True)
+    NormRating = np.zeros((index.shape[0], movies.shape[0]), dtype='float32')
+    NormRating[user_idx, mov_idx] = grades
+
+    C = (NormRating.T * NormRating.T).sum(0, keepdims=True) ** .5
+    D = np.nan_to_num(NormRating / C.T, nan=0.0, posinf=0.0, neginf=0.0)
+    SimMatrix = np.nan_to_num(D @ D.T, nan=0.0, posinf=0.0, neginf=0.0)
+    media_global = np.mean(NormRating[np.nonzero(NormRating)])
+
+    recs = []
+    for target in [line.strip() for line in open(targets)][1:]:
+        user, mov = (int(x[1:]) for x in target.split(":"))
+        cold_user = len(np.where(index == user)[0]) == 0
+        cold_mov = len(np.where(movies == mov)[0]) == 0
+        if not cold_user and not cold_mov:
+            ind_user = np.where(index == user)[0][0]
+            ind_mov = np.where(movies == mov)[0][0]
+            ind_UsersRtdMov = np.where(NormRating[:, ind_mov] > 0)[0]
+            ind_similars = np.where(SimMatrix[ind_user, :] != 0)[0]
+            ind_rated_sim = ind_similars[np.isin(ind_similars, ind_UsersRtdMov)]
+            sim_rated = SimMatrix[ind_user, ind_rated_sim]
+            topk_ind = ind_rated_sim[sim_rated.argsort()[-k:][::-1]]
+            topk_sim = SimMatrix[ind_user, topk_ind]
+            topk_rates = NormRating[topk_ind, ind_mov]
+            if topk_sim.shape[0] == 0:
+                recs.append(np.mean(NormRating[ind_UsersRtdMov, ind_mov]))
+            else:
+                recs.append(sum(np.multiply(topk_sim, topk_rates)) / sum(topk_sim))
+        elif not cold_user:
+            ind_user = np.where(index == user)[0][0]
+            recs.append(np.mean(NormRating[ind_user, np.nonzero(NormRating[ind_user, :])]))
+        elif not cold_mov:
+            ind_mov = np.where(movies == mov)[0][0]
+            recs.append(np.mean(NormRating[np.where(NormRating[:, ind_mov] > 0)[0], ind_mov]))
+        else:
+            recs.append(media_global)
+    return np.asarray(recs, dtype='float64')
+
+
+def test_full_index_matches_baseline_loop():
+    # com --neighbours 0 a saida so pode diferir da original por arredondamento na 4a casa
+    # (o fixture nao tem empates de similaridade no k-esimo vizinho)
+    model = fit(*build_rating_matrix(*read_ratings(RATINGS)), n_neighbours=0)
+    _, users, movs = read_targets(TARGETS)
+    preds = np.asarray(model.predict(users, movs, k=DEFAULT_K), dtype='float64')
+    expected = baseline_predictions(RATINGS, TARGETS)
+    assert preds.shape == expected.shape
+    assert np.abs(np.round(preds, 4) - np.round(expected, 4)).max() <= 1.5e-4
+
+
+def test_repeated_pair_keeps_last_rating(tmp_path):
+    ratings = tmp_path / "ratings.csv"
+    ratings.write_text("UserId:ItemId,Prediction\nu1:i1,3\nu1:i2,5\nu1:i1,8\nu2:i1,4\n")
+    RatingMatrix, user_map, mov_map = build_rating_matrix(*read_ratings(str(ratings)))
+    assert RatingMatrix.toarray().tolist() == [[8, 5], [4, 0]]
+